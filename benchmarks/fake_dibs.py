@@ -0,0 +1,151 @@
+"""
+A local stand-in for the DIBS gateway, for load testing.
+
+    python benchmarks/fake_dibs.py --port 8765 --md5-key1 ... --md5-key2 ...
+
+and set ``gateway_url = http://127.0.0.1:8765`` in the ``[pretix_paymentdibs]``
+section of pretix.cfg. It implements
+
+* ``/paymentweb/start.action``: checks the md5key, sends a signed callback to
+  the callbackurl and redirects the browser to the accepturl,
+* ``/cgi-adm/refund.cgi``: checks the md5key and answers with a text reply.
+
+Latency and failure rates can be configured to simulate a degraded acquirer.
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode
+from urllib.request import Request, urlopen
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pretix_paymentdibs import hashing  # NOQA
+
+_transact = itertools.count(100000000)
+
+
+class FakeDIBSHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.options.verbose:
+            super().log_message(format, *args)
+
+    def read_form(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return dict(parse_qsl(self.rfile.read(length).decode()))
+
+    def reply(self, status, body='', headers=None):
+        body = body.encode()
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        options = self.server.options
+        if options.latency:
+            time.sleep(random.expovariate(1 / options.latency))
+        path = self.path.split('?')[0]
+        if path == '/paymentweb/start.action':
+            self.start(self.read_form())
+        elif path == '/cgi-adm/refund.cgi':
+            self.refund(self.read_form())
+        else:
+            self.reply(404)
+
+    def start(self, form):
+        options = self.server.options
+        expected = hashing.md5key(options.md5_key1, options.md5_key2, form['merchant'], form['orderid'],
+                                  form['currency'], form['amount'])
+        if form.get('md5key') != expected:
+            self.reply(400, 'md5key mismatch')
+            return
+
+        transact = str(next(_transact))
+        declined = random.random() < options.decline_rate
+        params = {
+            'orderid': form['orderid'],
+            'transact': transact,
+            'amount': form['amount'],
+            'currency': form['currency'],
+            'statuscode': '1' if declined else ('5' if form.get('capturenow') else '2'),
+            'paytype': 'VISA',
+            'cardnomask': 'XXXXXXXXXXXX0000',
+            'cardexpdate': '2912',
+            'cardcountry': 'DK',
+            'authkey': hashing.authkey(options.md5_key1, options.md5_key2, transact, form['amount'], form['currency']),
+        }
+        if form.get('callbackurl'):
+            send_callback(form['callbackurl'], params)
+        target = form['cancelurl'] if declined else form['accepturl']
+        self.reply(303, headers={'Location': target + ('&' if '?' in target else '?') + urlencode(params)})
+
+    def refund(self, form):
+        options = self.server.options
+        expected = hashing.refund_md5key(options.md5_key1, options.md5_key2, form['merchant'], form['orderid'],
+                                         form['transact'], form['amount'])
+        if form.get('md5key') != expected:
+            reply = {'status': 'DECLINED', 'result': '8', 'message': 'md5key mismatch'}
+        elif random.random() < options.refund_fail_rate:
+            reply = {'status': 'DECLINED', 'result': random.choice(['1', '2', '11']), 'message': 'simulated failure'}
+        else:
+            reply = {'status': 'ACCEPTED', 'result': '0'}
+        self.reply(200, urlencode(reply))
+
+
+def send_callback(url, params):
+    try:
+        urlopen(Request(url, data=urlencode(params).encode(), method='POST'), timeout=30).read()
+    except OSError as e:
+        print('Callback to {} failed: {}'.format(url, e), file=sys.stderr)
+
+
+def make_server(host='127.0.0.1', port=0, md5_key1='', md5_key2='', latency=0.0, decline_rate=0.0,
+                refund_fail_rate=0.0, verbose=False):
+    server = ThreadingHTTPServer((host, port), FakeDIBSHandler)
+    server.daemon_threads = True
+    server.options = argparse.Namespace(md5_key1=md5_key1, md5_key2=md5_key2, latency=latency,
+                                        decline_rate=decline_rate, refund_fail_rate=refund_fail_rate,
+                                        verbose=verbose)
+    return server
+
+
+def start_in_thread(**kwargs):
+    """Start a fake gateway in a background thread, returns the server; its URL is server.url."""
+    server = make_server(**kwargs)
+    server.url = 'http://{}:{}'.format(*server.server_address[:2])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the DIBS gateway')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--md5-key1', required=True)
+    parser.add_argument('--md5-key2', required=True)
+    parser.add_argument('--latency', type=float, default=0.0, help='Mean simulated latency in seconds')
+    parser.add_argument('--decline-rate', type=float, default=0.0)
+    parser.add_argument('--refund-fail-rate', type=float, default=0.0,
+                        help='Share of refunds answered with a transient error')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.md5_key1, args.md5_key2, args.latency, args.decline_rate,
+                         args.refund_fail_rate, args.verbose)
+    print('Fake DIBS gateway listening on http://{}:{}'.format(args.host, args.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
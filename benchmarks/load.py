@@ -0,0 +1,198 @@
+"""
+Load test the DIBS plugin's hot paths and report throughput and latency.
+
+Scenarios:
+
+* ``callback``: signed callbacks posted to the webhook of a running pretix,
+* ``return``: the success redirect from DIBS to the return view,
+* ``redirect``: the auto-submit page sent before the DIBS payment window,
+  needs the session cookie of a browser that has just placed an order,
+* ``refund``: refund.cgi calls through the plugin's API client against an
+  in-process fake DIBS gateway (cf. fake_dibs.py).
+
+Example:
+
+    python benchmarks/load.py callback --event-url http://localhost:8000/org/event \\
+        --payment-id 12 13 14 --orderid org/event/ABCDE/1 org/event/FGHIJ/1 org/event/KLMNO/1 \\
+        --amount 1000 --currency 208 --md5-key1 ... --md5-key2 ... --concurrency 32 --requests 5000
+
+The callback scenario posts to the given payments in turn, the n-th order id
+belonging to the n-th payment id. The webhook rate limits callbacks per order
+id (``callback_rate_payment``, 1 per second by default), and rate limited
+callbacks count as errors. To measure throughput rather than the rate limit,
+set ``callback_rate_payment = 0`` in the ``[pretix_paymentdibs]`` section of
+the pretix configuration while benchmarking.
+"""
+import argparse
+import hashlib
+import itertools
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import HTTPRedirectHandler, Request, build_opener
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pretix_paymentdibs import hashing  # NOQA
+
+_transact = itertools.count(200000000)
+
+
+class NoRedirect(HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+opener = build_opener(NoRedirect)
+
+
+def http(url, data=None, headers=None):
+    req = Request(url, data=urlencode(data).encode() if data is not None else None, headers=headers or {},
+                  method='POST' if data is not None else 'GET')
+    try:
+        with opener.open(req, timeout=60) as r:
+            r.read()
+            return r.status
+    except HTTPError as e:
+        return e.code
+
+
+def callback_params(args, orderid):
+    transact = str(next(_transact))
+    return {
+        'orderid': orderid,
+        'transact': transact,
+        'amount': args.amount,
+        'currency': args.currency,
+        'statuscode': '2',
+        'paytype': 'VISA',
+        'cardnomask': 'XXXXXXXXXXXX0000',
+        'authkey': hashing.authkey(args.md5_key1, args.md5_key2, transact, args.amount, args.currency),
+    }
+
+
+def scenario_callback(args):
+    if len(args.payment_id) != len(args.orderid):
+        sys.exit('Give one --orderid per --payment-id.')
+    payments = itertools.cycle([
+        ('{}/pretix_paymentdibs/webhook/{}/'.format(args.event_url.rstrip('/'), payment_id), orderid)
+        for payment_id, orderid in zip(args.payment_id, args.orderid)
+    ])
+
+    def run():
+        url, orderid = next(payments)
+        return http(url, callback_params(args, orderid)) == 200
+
+    return run
+
+
+def scenario_return(args):
+    url = '{}/pretix_paymentdibs/return/{}/{}/{}/success'.format(
+        args.event_url.rstrip('/'), args.order_code, hashlib.sha1(args.order_secret.lower().encode()).hexdigest(),
+        args.payment_id[0]
+    )
+    return lambda: http(url + '?' + urlencode(callback_params(args, args.orderid[0]))) == 302
+
+
+def scenario_redirect(args):
+    url = '{}/pretix_paymentdibs/redirect/'.format(args.event_url.rstrip('/'))
+    headers = {'Cookie': '{}={}'.format(args.session_cookie_name, args.session_cookie)}
+    return lambda: http(url, headers=headers) == 200
+
+
+def scenario_refund(args):
+    from fake_dibs import start_in_thread
+
+    from pretix_paymentdibs.client import DIBSClient
+
+    server = start_in_thread(md5_key1=args.md5_key1, md5_key2=args.md5_key2, latency=args.gateway_latency)
+    client = DIBSClient(base_url=server.url, backoff=0)
+
+    def run():
+        transact = str(next(_transact))
+        data = {
+            'merchant': args.merchant, 'transact': transact, 'amount': args.amount, 'currency': args.currency,
+            'orderid': args.orderid[0], 'textreply': 'true',
+            'md5key': hashing.refund_md5key(args.md5_key1, args.md5_key2, args.merchant, args.orderid[0], transact,
+                                            args.amount),
+        }
+        return client.refund(data, auth=('user', 'password')).get('result') == ['0']
+
+    return run
+
+
+SCENARIOS = {
+    'callback': scenario_callback,
+    'return': scenario_return,
+    'redirect': scenario_redirect,
+    'refund': scenario_refund,
+}
+
+
+def timed(fn):
+    start = time.perf_counter()
+    try:
+        ok = fn()
+    except Exception:
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run(fn, concurrency, total, warmup):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(lambda _: timed(fn), range(warmup)))
+        start = time.perf_counter()
+        results = list(executor.map(lambda _: timed(fn), range(total)))
+        elapsed = time.perf_counter() - start
+    latencies = sorted(r[0] for r in results)
+    return {
+        'requests': total,
+        'errors': len([r for r in results if not r[1]]),
+        'throughput': total / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--event-url', help='Public URL of the event, e.g. http://localhost:8000/org/event')
+    parser.add_argument('--payment-id', type=int, nargs='+', default=[])
+    parser.add_argument('--orderid', nargs='+', default=['org/event/ABCDE/1'], help='DIBS order ids of the payments')
+    parser.add_argument('--order-code')
+    parser.add_argument('--order-secret')
+    parser.add_argument('--amount', default='1000', help='Amount in minor units')
+    parser.add_argument('--currency', default='208', help='Numeric currency code')
+    parser.add_argument('--merchant', default='12345678')
+    parser.add_argument('--md5-key1', default='')
+    parser.add_argument('--md5-key2', default='')
+    parser.add_argument('--session-cookie')
+    parser.add_argument('--session-cookie-name', default='pretix_session')
+    parser.add_argument('--gateway-latency', type=float, default=0.0,
+                        help='Mean latency of the fake gateway in the refund scenario, in seconds')
+    args = parser.parse_args()
+
+    fn = SCENARIOS[args.scenario](args)
+    print('{:>11} {:>9} {:>7} {:>10} {:>9} {:>9}'.format('concurrency', 'requests', 'errors', 'req/s', 'p50 ms',
+                                                          'p99 ms'))
+    for concurrency in args.concurrency:
+        r = run(fn, concurrency, args.requests, args.warmup)
+        print('{:>11} {:>9} {:>7} {:>10.1f} {:>9.1f} {:>9.1f}'.format(concurrency, r['requests'], r['errors'],
+                                                                       r['throughput'], r['p50_ms'], r['p99_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Measure what loading the plugin costs a pretix worker.
+
+Every measurement runs in a fresh interpreter: Django is set up first, then
+the given plugin modules are imported, and the import time and the growth of
+the maximum resident set size are reported.
+
+    DJANGO_SETTINGS_MODULE=pretix.testutils.settings python benchmarks/startup.py
+
+Use --max-import-ms / --max-rss-kb to fail (exit code 1) when a module gets
+more expensive than expected, e.g. in CI.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+MODULES = [
+    'pretix_paymentdibs.signals',
+    'pretix_paymentdibs.urls',
+    'pretix_paymentdibs.payment',
+]
+
+PROBE = '''
+import json, resource, sys, time
+import django
+django.setup()
+before_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+before_modules = set(sys.modules)
+start = time.perf_counter()
+__import__({module!r})
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    'import_ms': elapsed * 1000,
+    'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before_rss,
+    'new_modules': len(set(sys.modules) - before_modules),
+}}))
+'''
+
+
+def measure(module, repeat):
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', PROBE.format(module=module)], check=True, capture_output=True,
+                             text=True).stdout
+        runs.append(json.loads(out.strip().splitlines()[-1]))
+    return {
+        'import_ms': statistics.median(r['import_ms'] for r in runs),
+        'rss_kb': statistics.median(r['rss_kb'] for r in runs),
+        'new_modules': runs[0]['new_modules'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-import-ms', type=float)
+    parser.add_argument('--max-rss-kb', type=float)
+    args = parser.parse_args()
+
+    failed = False
+    print('{:<40} {:>10} {:>10} {:>8}'.format('module', 'import ms', 'rss kb', 'modules'))
+    for module in args.modules:
+        r = measure(module, args.repeat)
+        print('{:<40} {:>10.1f} {:>10.0f} {:>8}'.format(module, r['import_ms'], r['rss_kb'], r['new_modules']))
+        if args.max_import_ms is not None and r['import_ms'] > args.max_import_ms:
+            failed = True
+        if args.max_rss_kb is not None and r['rss_kb'] > args.max_rss_kb:
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
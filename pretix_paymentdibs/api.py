@@ -0,0 +1,22 @@
+from rest_framework import viewsets
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+from .statistics import summary
+
+
+class DIBSStatisticsViewSet(viewsets.ViewSet):
+    """
+    DIBS payment statistics of an event, cf. statistics.summary.
+    Takes the number of days to cover as the ``days`` query parameter.
+    """
+    permission = 'can_view_orders'
+
+    def list(self, request, *args, **kwargs):
+        try:
+            days = int(request.query_params.get('days', 30))
+        except ValueError:
+            raise ValidationError({'days': ['Must be an integer.']})
+        if not 0 < days <= 366:
+            raise ValidationError({'days': ['Must be between 1 and 366.']})
+        return Response(summary(request.event, days))
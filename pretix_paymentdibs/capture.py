@@ -0,0 +1,161 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils.timezone import now
+from django_scopes import scope
+
+from pretix.base.models import Order, OrderPayment
+
+from . import hashing
+from .utils import RateLimiter, cache_key, cache_lock
+
+logger = logging.getLogger('pretix.plugins.payment_dibs')
+
+
+def _config(name, fallback):
+    return settings.CONFIG_FILE.getint('pretix_paymentdibs', name, fallback=fallback)
+
+
+def authorised_payment_ids():
+    """Ids of confirmed DIBS payments that were only authorised and are due for capture, oldest first."""
+    from .payment import DIBS
+
+    return OrderPayment.objects.filter(
+        provider=DIBS.identifier,
+        state=OrderPayment.PAYMENT_STATE_CONFIRMED,
+        # Authorisations expire after 7 days
+        payment_date__gt=now() - timedelta(days=7),
+        payment_date__lt=now() - timedelta(minutes=_config('capture_after_minutes', 60)),
+        info__contains='"capture": "{}"'.format(DIBS.CAPTURE_PENDING),
+    ).order_by('pk').values_list('pk', flat=True)
+
+
+def capture_payload(payment, provider, amount):
+    from .payment import DIBS
+
+    config = provider.config
+    merchant = provider.merchant_for(payment)
+    info = payment.info_data
+    amount = DIBS.get_amount(amount)
+    payload = {
+        'merchant': merchant.merchant_id,
+        'transact': info['transact'],
+        'amount': amount,
+        'orderid': info['orderid'],
+        'textreply': 'true',
+        'md5key': hashing.capture_md5key(merchant.md5_key1, merchant.md5_key2, merchant.merchant_id, info['orderid'],
+                                         info['transact'], amount),
+    }
+    if config.test_mode:
+        payload['test'] = 1
+    return payload
+
+
+def _capture(payment, provider, payload, limiter):
+    from .client import get_client
+
+    try:
+        limiter.wait(payload['merchant'])
+        return payment, get_client().capture(payload, provider.get_api_authorization())
+    except Exception:
+        logger.exception('Could not capture DIBS payment %s', payment.pk)
+        return payment, None
+
+
+def set_capture_state(payment, capture, result=None):
+    """
+    Record the capture state of a payment that is pending capture, unless
+    another worker got there first. Staff are notified of failed captures,
+    as the order stays paid without the money being collected.
+    """
+    from .payment import DIBS
+
+    with cache_lock(cache_key('capture_lock', payment.pk)) as acquired:
+        if not acquired:
+            return False
+        payment.refresh_from_db(fields=['info'])
+        info = payment.info_data
+        if info.get('capture') != DIBS.CAPTURE_PENDING:
+            return False
+        info['capture'] = capture
+        if result is not None:
+            info['capture_result'] = result
+        payment.info_data = info
+        payment.save(update_fields=['info'])
+        payment.order.log_action(
+            'pretix_paymentdibs.capture.failed' if capture == DIBS.CAPTURE_FAILED else 'pretix_paymentdibs.capture',
+            data={'local_id': payment.local_id, 'capture': capture, 'result': result},
+        )
+        return True
+
+
+def apply_capture_result(payment, reply):
+    """Store the outcome of a capture call on the payment."""
+    from .client import TRANSIENT_RESULTS
+    from .payment import DIBS
+
+    try:
+        result = int(reply['result'][0])
+    except (KeyError, ValueError):
+        return
+    if result in TRANSIENT_RESULTS:
+        # Try again in the next run
+        return
+    if result in (DIBS.REFUND_ACCEPTED,
+                  DIBS.REFUND_CAPTURE_IS_CALLED_FOR_A_TRANSACTION_WHICH_IS_PENDING_FOR_BATCH_I_E_CAPTURE_WAS_ALREADY_CALLED):
+        set_capture_state(payment, DIBS.CAPTURE_DONE, result)
+    else:
+        set_capture_state(payment, DIBS.CAPTURE_FAILED, result)
+
+
+def capture_authorised_payments():
+    """
+    Capture DIBS payments that were only authorised at checkout.
+
+    Works like reconciliation: payments are loaded in chunks, capture.cgi is
+    called concurrently (rate limited per merchant) and the results are
+    stored sequentially. Payments of canceled orders are not captured, and
+    amounts refunded through DIBS are left out of the capture.
+
+    Must be called with scopes disabled.
+    """
+    from .payment import DIBS
+
+    chunk_size = _config('capture_chunk_size', 200)
+    limiter = RateLimiter(_config('capture_rate', 5))
+    ids = authorised_payment_ids().iterator(chunk_size=chunk_size)
+    providers = {}
+    captured = 0
+
+    with ThreadPoolExecutor(max_workers=_config('capture_workers', 8)) as executor:
+        while True:
+            chunk = [pk for _, pk in zip(range(chunk_size), ids)]
+            if not chunk:
+                break
+            payments = OrderPayment.objects.filter(pk__in=chunk).select_related(
+                'order', 'order__event', 'order__event__organizer'
+            )
+            jobs = []
+            for payment in payments:
+                # Refunds are only made once a payment is captured, but never collect money that was given back.
+                amount = DIBS.refundable_amount(payment)
+                if payment.order.status == Order.STATUS_CANCELED or amount <= 0:
+                    with scope(organizer=payment.order.event.organizer):
+                        set_capture_state(payment, DIBS.CAPTURE_SKIPPED)
+                    continue
+                if payment.order.event_id not in providers:
+                    providers[payment.order.event_id] = payment.payment_provider
+                provider = providers[payment.order.event_id]
+                if not all(provider.get_api_authorization()):
+                    continue
+                jobs.append((payment, provider, capture_payload(payment, provider, amount)))
+
+            for payment, reply in executor.map(lambda job: _capture(*job, limiter), jobs):
+                if reply is None:
+                    continue
+                with scope(organizer=payment.order.event.organizer):
+                    apply_capture_result(payment, reply)
+                captured += 1
+    return captured
@@ -0,0 +1,104 @@
+import time
+
+from django.core.cache import cache
+
+from .utils import cache_key
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker whose state is shared between all workers through the cache.
+
+    The circuit opens when at least `min_calls` calls were made in the current
+    `window` (seconds) and at least `error_ratio` of them failed. While open,
+    calls fail immediately. After `open_for` seconds the circuit is half-open:
+    a single probe call is let through, which closes the circuit if it succeeds
+    and opens it again if it fails.
+    """
+
+    def __init__(self, name, window=60, min_calls=5, error_ratio=0.5, open_for=30):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_ratio = error_ratio
+        self.open_for = open_for
+
+    def key(self, *parts):
+        return cache_key('circuit', self.name, *parts)
+
+    def bucket(self):
+        return int(time.time() // self.window)
+
+    def _incr(self, key):
+        cache.add(key, 0, self.window * 2)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # The key expired between add() and incr()
+            cache.set(key, 1, self.window * 2)
+            return 1
+
+    @property
+    def state(self):
+        open_until = cache.get(self.key('open_until'))
+        if open_until is None:
+            return STATE_CLOSED
+        if time.time() < open_until:
+            return STATE_OPEN
+        return STATE_HALF_OPEN
+
+    def stats(self):
+        bucket = self.bucket()
+        calls = cache.get(self.key('calls', bucket)) or 0
+        errors = cache.get(self.key('errors', bucket)) or 0
+        return {
+            'state': self.state,
+            'calls': calls,
+            'errors': errors,
+            'error_ratio': errors / calls if calls else 0.0,
+            'latency': cache.get(self.key('latency')),
+        }
+
+    def before_call(self):
+        """Returns whether the call is a half-open probe, raises CircuitOpenError if the call must not be made."""
+        state = self.state
+        if state == STATE_CLOSED:
+            return False
+        if state == STATE_HALF_OPEN and cache.add(self.key('probe'), True, self.open_for):
+            return True
+        raise CircuitOpenError(self.name)
+
+    def record(self, success, duration, probe=False):
+        latency = cache.get(self.key('latency'))
+        cache.set(self.key('latency'), duration if latency is None else 0.8 * latency + 0.2 * duration, 3600)
+
+        bucket = self.bucket()
+        calls = self._incr(self.key('calls', bucket))
+        if success:
+            if probe:
+                cache.delete_many([self.key('open_until'), self.key('probe'), self.key('errors', bucket)])
+            return
+
+        errors = self._incr(self.key('errors', bucket))
+        if probe or (calls >= self.min_calls and errors / calls >= self.error_ratio):
+            cache.set(self.key('open_until'), time.time() + self.open_for, self.open_for + self.window * 2)
+            cache.delete(self.key('probe'))
+
+    def call(self, fn, is_failure=lambda result: False):
+        probe = self.before_call()
+        start = time.perf_counter()
+        try:
+            result = fn()
+        except Exception:
+            self.record(False, time.perf_counter() - start, probe)
+            raise
+        self.record(not is_failure(result), time.perf_counter() - start, probe)
+        return result
@@ -0,0 +1,152 @@
+import logging
+import threading
+import time
+from urllib.parse import parse_qs
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+from .circuitbreaker import CircuitBreaker
+from .utils import DIBS_BASE_URL, get_gateway_url
+
+logger = logging.getLogger('pretix.plugins.payment_dibs')
+
+# https://tech.dibspayment.com/D2/API/Error_codes
+# These results mean that the acquirer did not act on the request, so it is safe to send it again.
+TRANSIENT_RESULTS = frozenset({
+    1,   # REFUND_NO_RESPONSE_FROM_ACQUIRER
+    2,   # REFUND_TIMEOUT
+    11,  # REFUND_NOT_ABLE_TO_COMMUNICATE_WITH_THE_ACQUIER
+})
+
+
+class RequestsTransport:
+    """
+    Sends form posts through one pooled keep-alive session per merchant.
+    """
+
+    def __init__(self, pool_maxsize=10):
+        self.pool_maxsize = pool_maxsize
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session(self, merchant):
+        with self._lock:
+            if merchant not in self._sessions:
+                session = requests.Session()
+                # Retries are handled by DIBSClient, which knows which failures are safe to repeat.
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize, max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._sessions[merchant] = session
+            return self._sessions[merchant]
+
+    def __call__(self, merchant, url, data, auth, timeout):
+        r = self.session(merchant).post(url, data=data, auth=auth, timeout=timeout)
+        return r.text
+
+
+class DIBSClient:
+    """
+    Client for the DIBS admin API (refund.cgi and friends).
+
+    `transport` is a callable ``(merchant, url, data, auth, timeout) -> str``
+    returning the response body; pass a custom one to talk to a stand-in.
+    """
+
+    def __init__(self, base_url=DIBS_BASE_URL, connect_timeout=5, read_timeout=30, max_attempts=3, backoff=0.5,
+                 transport=None, breaker=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.transport = transport or RequestsTransport()
+        self.breaker = breaker
+
+    def post(self, path, data, auth):
+        """
+        Post to an admin API endpoint and return the parsed text reply.
+
+        Failures to connect and transient DIBS results are retried with
+        exponential backoff. Other errors, such as read timeouts or connections
+        reset after the request was sent, are not, as the request may already
+        have been executed.
+
+        If the client has a circuit breaker, errors and transient results that
+        remain after retrying count as failures, and CircuitOpenError is raised
+        without contacting DIBS while the circuit is open.
+        """
+        if self.breaker is None:
+            return self._post(path, data, auth)
+        return self.breaker.call(lambda: self._post(path, data, auth), is_failure=is_transient_reply)
+
+    def _post(self, path, data, auth):
+        url = self.base_url + path
+        merchant = data.get('merchant')
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                body = self.transport(merchant, url, data, auth, self.timeout)
+            except requests.ConnectionError as e:
+                if not is_unsent(e) or attempt >= self.max_attempts:
+                    raise
+                logger.warning('Could not connect to DIBS (attempt %d of %d)', attempt, self.max_attempts)
+            else:
+                reply = parse_qs(body)
+                result = int(reply['result'][0]) if 'result' in reply else -1
+                if result not in TRANSIENT_RESULTS or attempt >= self.max_attempts:
+                    return reply
+                logger.warning('Transient DIBS result %d (attempt %d of %d)', result, attempt, self.max_attempts)
+            time.sleep(self.backoff * 2 ** (attempt - 1))
+
+    def refund(self, data, auth):
+        # https://tech.dibspayment.com/D2/API/Payment_functions/refundcgi
+        return self.post('/cgi-adm/refund.cgi', data, auth)
+
+    def capture(self, data, auth):
+        # https://tech.dibspayment.com/D2/API/Payment_functions/capturecgi
+        return self.post('/cgi-bin/capture.cgi', data, auth)
+
+    def transaction_info(self, data, auth):
+        """Find the transaction of an order, given merchant, orderid, currency and amount."""
+        # https://tech.dibspayment.com/D2/API/Payment_functions/transinfocgi
+        return self.post('/cgi-bin/transinfo.cgi', data, auth)
+
+    def payment_info(self, data, auth):
+        """Get the status of a transaction, given merchant and transact."""
+        # https://tech.dibspayment.com/D2/API/Payment_functions/payinfocgi
+        return self.post('/cgi-adm/payinfo.cgi', data, auth)
+
+
+def is_unsent(exc):
+    """Whether a connection error happened before the request was sent, so it is safe to send it again."""
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def is_transient_reply(reply):
+    return 'result' in reply and int(reply['result'][0]) in TRANSIENT_RESULTS
+
+
+def get_breaker():
+    return CircuitBreaker('admin_api')
+
+
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = DIBSClient(base_url=get_gateway_url(), breaker=get_breaker())
+    return _client
+
+
+def set_client(client):
+    """Replace the module-level client, e.g. with one using a test transport."""
+    global _client
+    _client = client
@@ -0,0 +1,60 @@
+# DIBS identifies currencies by their numeric ISO 4217 code. This table covers the currencies accepted by DIBS, so
+# lookups do not have to load the pycountry database. pycountry is only used for currencies missing here.
+# https://tech.dibspayment.com/D2/Toolbox/Currency_codes
+NUMERIC_CODES = {
+    'AUD': '036',
+    'BGN': '975',
+    'BRL': '986',
+    'CAD': '124',
+    'CHF': '756',
+    'CNY': '156',
+    'CZK': '203',
+    'DKK': '208',
+    'EUR': '978',
+    'GBP': '826',
+    'HKD': '344',
+    'HRK': '191',
+    'HUF': '348',
+    'ILS': '376',
+    'INR': '356',
+    'ISK': '352',
+    'JPY': '392',
+    'KRW': '410',
+    'MXN': '484',
+    'NOK': '578',
+    'NZD': '554',
+    'PLN': '985',
+    'RON': '946',
+    'RUB': '643',
+    'SEK': '752',
+    'SGD': '702',
+    'THB': '764',
+    'TRY': '949',
+    'UAH': '980',
+    'USD': '840',
+    'ZAR': '710',
+}
+
+ALPHA_3_CODES = {numeric: alpha_3 for alpha_3, numeric in NUMERIC_CODES.items()}
+
+
+def get_numeric_code(alpha_3):
+    """Get the numeric code, e.g. "208", of an alpha-3 currency code, e.g. "DKK"."""
+    try:
+        return NUMERIC_CODES[alpha_3]
+    except KeyError:
+        import pycountry
+
+        return str(pycountry.currencies.get(alpha_3=alpha_3).numeric)
+
+
+def get_alpha_3_code(numeric):
+    """Get the alpha-3 code, e.g. "DKK", of a numeric currency code, e.g. "208", or None for unknown codes."""
+    numeric = str(numeric).zfill(3)
+    try:
+        return ALPHA_3_CODES[numeric]
+    except KeyError:
+        import pycountry
+
+        currency = pycountry.currencies.get(numeric=numeric)
+        return currency.alpha_3 if currency else None
@@ -0,0 +1,104 @@
+from collections import OrderedDict
+
+from django import forms
+from django.utils.translation import gettext_lazy as _, pgettext_lazy
+
+from pretix.base.exporter import ListExporter
+from pretix.base.models import OrderPayment, OrderRefund
+
+from .payment import DIBS
+
+
+class DIBSTransactionExporter(ListExporter):
+    identifier = 'dibs_transactions'
+    verbose_name = _('DIBS transactions')
+    category = pgettext_lazy('export_category', 'Payments')
+    description = _('Download a spreadsheet of all DIBS payments and refunds, e.g. for settlement.')
+
+    # Rows are fetched from the database in chunks of this size.
+    chunk_size = 2000
+
+    @property
+    def additional_form_fields(self):
+        return OrderedDict([
+            ('include_refunds', forms.BooleanField(
+                label=_('Include refunds'),
+                required=False,
+                initial=True,
+            )),
+        ])
+
+    def get_filename(self):
+        if self.is_multievent:
+            return '{}_dibs_transactions'.format(self.organizer.slug)
+        return '{}_dibs_transactions'.format(self.event.slug)
+
+    def payments(self):
+        return OrderPayment.objects.filter(
+            order__event__in=self.events, provider=DIBS.identifier,
+        ).select_related('order', 'order__event').only(
+            'local_id', 'state', 'amount', 'payment_date', 'created', 'info',
+            'order__code', 'order__event__slug', 'order__event__currency',
+        ).order_by('pk')
+
+    def refunds(self):
+        return OrderRefund.objects.filter(
+            order__event__in=self.events, provider=DIBS.identifier,
+        ).select_related('order', 'order__event', 'payment').only(
+            'local_id', 'state', 'amount', 'execution_date', 'created', 'info',
+            'order__code', 'order__event__slug', 'order__event__currency', 'payment__info',
+        ).order_by('pk')
+
+    def iterate_list(self, form_data):
+        include_refunds = form_data.get('include_refunds', True)
+        payments = self.payments()
+        refunds = self.refunds()
+
+        total = payments.count() + (refunds.count() if include_refunds else 0)
+        yield self.ProgressSetTotal(total=total)
+
+        yield [
+            _('Type'), _('Event'), _('Order code'), _('ID'), _('Date'), _('Status'), _('Amount'), _('Currency'),
+            _('Transaction'), _('Payment type'), _('Card type'), _('Status code'), _('Refund result'),
+        ]
+
+        for p in payments.iterator(chunk_size=self.chunk_size):
+            info = p.info_data
+            yield [
+                _('Payment'),
+                p.order.event.slug,
+                p.order.code,
+                p.full_id,
+                (p.payment_date or p.created).isoformat(),
+                p.state,
+                p.amount,
+                p.order.event.currency,
+                info.get('transact'),
+                info.get('paytype'),
+                DIBS.get_card_type(info.get('paytype')),
+                info.get('statuscode'),
+                None,
+            ]
+
+        if not include_refunds:
+            return
+
+        for r in refunds.iterator(chunk_size=self.chunk_size):
+            # Refund info is the parsed text reply of refund.cgi, i.e. a list per field.
+            info = r.info_data
+            payment_info = r.payment.info_data if r.payment else {}
+            yield [
+                _('Refund'),
+                r.order.event.slug,
+                r.order.code,
+                r.full_id,
+                (r.execution_date or r.created).isoformat(),
+                r.state,
+                r.amount,
+                r.order.event.currency,
+                payment_info.get('transact'),
+                payment_info.get('paytype'),
+                DIBS.get_card_type(payment_info.get('paytype')),
+                payment_info.get('statuscode'),
+                info['result'][0] if 'result' in info else None,
+            ]
@@ -0,0 +1,57 @@
+import hashlib
+
+# https://tech.dibspayment.com/D2/API/MD5
+# https://tech.dibspayment.com/D2/Hosted/Md5_calculation
+#
+# This module has no dependencies on Django or pretix, so the fake DIBS
+# gateway in benchmarks/ can sign requests exactly like the plugin does.
+
+
+def md5(s):
+    """Calculate md5 hash of a string"""
+    return hashlib.md5(s.encode('utf-8')).hexdigest()
+
+
+def double_md5(key1, key2, parameters):
+    return md5(key2 + md5(key1 + parameters))
+
+
+def md5key(key1, key2, merchant, orderid, currency, amount):
+    """The md5key sent with a payment request."""
+    return double_md5(key1, key2, 'merchant=' + merchant + '&orderid=' + orderid + '&currency=' + currency + '&amount=' + amount)
+
+
+def refund_md5key(key1, key2, merchant, orderid, transact, amount):
+    """The md5key sent with a refund request."""
+    return double_md5(key1, key2, 'merchant=' + merchant + '&orderid=' + orderid + '&transact=' + transact + '&amount=' + amount)
+
+
+def capture_md5key(key1, key2, merchant, orderid, transact, amount):
+    """The md5key sent with a capture request."""
+    return double_md5(key1, key2, 'merchant=' + merchant + '&orderid=' + orderid + '&transact=' + transact + '&amount=' + amount)
+
+
+def authkey(key1, key2, transact, amount, currency):
+    """The authkey DIBS sends with a callback."""
+    return double_md5(key1, key2, 'transact=' + transact + '&amount=' + amount + '&currency=' + currency)
+
+
+class PrefixedDoubleMD5:
+    """
+    Computes double_md5(key1, key2, parameters) for many parameter strings
+    with the same keys, hashing the constant key prefixes only once.
+    """
+
+    def __init__(self, key1, key2):
+        self.inner = hashlib.md5(key1.encode('utf-8'))
+        self.outer = hashlib.md5(key2.encode('utf-8'))
+
+    def __call__(self, parameters):
+        inner = self.inner.copy()
+        inner.update(parameters.encode('utf-8'))
+        outer = self.outer.copy()
+        outer.update(inner.hexdigest().encode('utf-8'))
+        return outer.hexdigest()
+
+    def authkey(self, transact, amount, currency):
+        return self('transact=' + transact + '&amount=' + amount + '&currency=' + currency)
@@ -0,0 +1,105 @@
+import hmac
+import json
+import multiprocessing
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django_scopes import scopes_disabled
+
+from pretix.base.models import Event, LogEntry
+
+from pretix_paymentdibs.hashing import PrefixedDoubleMD5
+from pretix_paymentdibs.payment import DIBS
+
+OK = 'ok'
+MISMATCH = 'mismatch'
+INCOMPLETE = 'incomplete'
+
+# Per worker process: (key1, key2) -> PrefixedDoubleMD5
+_hashers = {}
+
+
+def verify_batch(batch):
+    """Check the authkeys of a batch of (log entry, keys, transact, amount, currency, authkey) tuples."""
+    results = []
+    for pk, keys, transact, amount, currency, authkey in batch:
+        if keys not in _hashers:
+            _hashers[keys] = PrefixedDoubleMD5(*keys)
+        expected = _hashers[keys].authkey(transact, amount, currency)
+        results.append((pk, OK if hmac.compare_digest(expected, authkey) else MISMATCH))
+    return results
+
+
+class Command(BaseCommand):
+    help = 'Recompute and check the authkeys of stored DIBS callbacks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--organizer', help='Organizer slug')
+        parser.add_argument('--event', help='Event slug, requires --organizer')
+        parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def entries(self, options):
+        qs = LogEntry.objects.filter(action_type='pretix_paymentdibs.callback')
+        if options['event']:
+            if not options['organizer']:
+                raise CommandError('--event requires --organizer.')
+            qs = qs.filter(event__organizer__slug=options['organizer'], event__slug=options['event'])
+        elif options['organizer']:
+            qs = qs.filter(event__organizer__slug=options['organizer'])
+        return qs.order_by('pk').values_list('pk', 'event_id', 'data').iterator(chunk_size=options['batch_size'])
+
+    def keys(self, event_id, merchant_id):
+        if (event_id, merchant_id) not in self._keys:
+            merchants = DIBS(Event.objects.get(pk=event_id)).config.merchants
+            # Callbacks logged before merchants were recorded belong to the main merchant.
+            merchant = next((m for m in merchants if m.merchant_id == merchant_id), merchants[0])
+            self._keys[event_id, merchant_id] = (merchant.md5_key1 or '', merchant.md5_key2 or '')
+        return self._keys[event_id, merchant_id]
+
+    def batches(self, options):
+        # The pool consumes this generator in its own thread, which does not inherit the disabled scopes.
+        with scopes_disabled():
+            batch = []
+            for pk, event_id, data in self.entries(options):
+                info = json.loads(data) if data else {}
+                try:
+                    batch.append((pk, self.keys(event_id, info.get('merchant')), info['transact'], str(info['amount']),
+                                  str(info['currency_code']), info['authkey']))
+                except KeyError:
+                    self.incomplete.append(pk)
+                    continue
+                if len(batch) >= options['batch_size']:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        self._keys = {}
+        self.incomplete = []
+        counts = Counter()
+        mismatches = []
+
+        # Do not share the database connection with the forked workers.
+        connection.close()
+        with multiprocessing.Pool(options['workers']) as pool:
+            for results in pool.imap_unordered(verify_batch, self.batches(options)):
+                for pk, result in results:
+                    counts[result] += 1
+                    if result == MISMATCH:
+                        mismatches.append(pk)
+
+        for entry in LogEntry.objects.filter(pk__in=mismatches).select_related('event', 'content_type').order_by('pk'):
+            self.stdout.write('Authkey mismatch: log entry {}, event {}, {} {}, transact {}'.format(
+                entry.pk, entry.event.slug if entry.event else '-', entry.content_type.model, entry.object_id,
+                entry.parsed_data.get('transact'),
+            ))
+
+        self.stdout.write('Valid: {}'.format(counts[OK]))
+        self.stdout.write('Mismatch: {}'.format(counts[MISMATCH]))
+        self.stdout.write('Incomplete (no authkey, amount or currency stored): {}'.format(len(self.incomplete)))
+        if counts[MISMATCH]:
+            raise CommandError('{} callbacks failed verification.'.format(counts[MISMATCH]))
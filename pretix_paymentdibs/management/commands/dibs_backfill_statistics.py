@@ -0,0 +1,96 @@
+from collections import Counter, defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django_scopes import scopes_disabled
+
+from pretix.base.models import Event, LogEntry, OrderPayment, OrderRefund
+
+from pretix_paymentdibs import hashing
+from pretix_paymentdibs.management.commands.dibs_compact_callback_data import batches
+from pretix_paymentdibs.models import PaymentStatistic
+from pretix_paymentdibs.payment import DIBS
+from pretix_paymentdibs.statistics import callback_values, event_date
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the DIBS payment statistics of the days before today from callback log entries and refunds'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--organizer', help='Organizer slug')
+        parser.add_argument('--event', help='Event slug, requires --organizer')
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def events(self, options):
+        events = Event.objects.all()
+        if options['event']:
+            if not options['organizer']:
+                raise CommandError('--event requires --organizer.')
+            events = events.filter(organizer__slug=options['organizer'], slug=options['event'])
+        elif options['organizer']:
+            events = events.filter(organizer__slug=options['organizer'])
+        return events
+
+    def verified_callbacks(self, event, batch_size):
+        """
+        Date and data of the callback log entries of an event with a valid
+        authkey, which are the ones counted as they are processed, cf.
+        DIBS._handle_callback.
+        """
+        provider = DIBS(event)
+        merchants = {m.merchant_id: m for m in provider.config.merchants}
+        currency = provider.currency_code
+        entries = LogEntry.objects.filter(event=event, action_type='pretix_paymentdibs.callback').only(
+            'pk', 'datetime', 'object_id', 'data'
+        )
+        for batch in batches(entries, batch_size):
+            amounts = defaultdict(set)
+            payments = OrderPayment.objects.filter(
+                order_id__in={e.object_id for e in batch}, provider=DIBS.identifier,
+            ).values_list('order_id', 'amount')
+            for order_id, amount in payments:
+                amounts[order_id].add(DIBS.get_amount(amount))
+            for entry in batch:
+                data = entry.parsed_data
+                if 'statuscode' not in data or 'authkey' not in data or 'transact' not in data:
+                    continue
+                # Entries written before the merchant was recorded were made with the main merchant.
+                merchant = merchants.get(data.get('merchant'), provider.config.merchants[0])
+                if not merchant.md5_key1 or not merchant.md5_key2:
+                    continue
+                if any(data['authkey'] == hashing.authkey(merchant.md5_key1, merchant.md5_key2, str(data['transact']),
+                                                          amount, currency)
+                       for amount in amounts[entry.object_id]):
+                    yield entry.datetime, data
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        for event in self.events(options).iterator():
+            # Today's counters are left to the callbacks and refunds processed meanwhile.
+            today = event_date(event)
+            counts = Counter()
+
+            for dt, data in self.verified_callbacks(event, options['batch_size']):
+                for kind, value in callback_values(data):
+                    counts[event_date(event, dt), kind, str(value)] += 1
+
+            refunds = OrderRefund.objects.filter(
+                order__event=event, provider=DIBS.identifier,
+                state__in=(OrderRefund.REFUND_STATE_DONE, OrderRefund.REFUND_STATE_FAILED),
+            )
+            for refund in refunds.only('created', 'execution_date', 'info').iterator(chunk_size=options['batch_size']):
+                info = refund.info_data
+                result = info['result'][0] if 'result' in info else 'error'
+                counts[event_date(event, refund.execution_date or refund.created),
+                       PaymentStatistic.KIND_REFUND_RESULT, result] += 1
+
+            counts = {key: count for key, count in counts.items() if key[0] < today}
+            if not counts:
+                continue
+            with transaction.atomic():
+                PaymentStatistic.objects.filter(event=event, date__lt=today).delete()
+                PaymentStatistic.objects.bulk_create([
+                    PaymentStatistic(event=event, date=date, kind=kind, value=value, count=count)
+                    for (date, kind, value), count in counts.items()
+                ], batch_size=options['batch_size'])
+            self.stdout.write('{}/{}: {} counters'.format(event.organizer.slug, event.slug, len(counts)))
@@ -0,0 +1,74 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef
+from django_scopes import scopes_disabled
+
+from pretix.base.models import Event, OrderPayment, OrderRefund
+
+from pretix_paymentdibs.management.commands.dibs_compact_callback_data import batches
+from pretix_paymentdibs.models import DIBSTransaction
+from pretix_paymentdibs.payment import DIBS
+from pretix_paymentdibs.transactions import payment_values, refund_values
+
+
+class Command(BaseCommand):
+    help = 'Fill the DIBS transaction table from stored payments and refunds'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def merchant(self, event_id, info):
+        if info.get('merchant'):
+            return info['merchant']
+        # The merchant used at the time is not stored, assume it has not changed since.
+        if event_id not in self._merchants:
+            self._merchants[event_id] = DIBS(Event.objects.get(pk=event_id)).config.merchant_id
+        return self._merchants[event_id]
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        self._merchants = {}
+
+        payments = OrderPayment.objects.filter(provider=DIBS.identifier).exclude(
+            Exists(DIBSTransaction.objects.filter(payment=OuterRef('pk'), kind=DIBSTransaction.KIND_PAYMENT))
+        ).exclude(
+            info__isnull=True
+        ).select_related('order').only('pk', 'amount', 'info', 'payment_date', 'created', 'order__event_id')
+        created = 0
+        for batch in batches(payments, options['batch_size']):
+            rows = []
+            for p in batch:
+                info = p.info_data
+                if 'transact' not in info or 'orderid' not in info:
+                    continue
+                rows.append(DIBSTransaction(
+                    kind=DIBSTransaction.KIND_PAYMENT, payment=p, created=p.payment_date or p.created,
+                    **payment_values(p, info, self.merchant(p.order.event_id, info))
+                ))
+            # Rows stored by callbacks or refunds processed in the meantime are kept.
+            DIBSTransaction.objects.bulk_create(rows, ignore_conflicts=True)
+            created += len(rows)
+        self.stdout.write('Stored {} payment transactions'.format(created))
+
+        refunds = OrderRefund.objects.filter(
+            provider=DIBS.identifier, dibs_transaction__isnull=True,
+            state__in=(OrderRefund.REFUND_STATE_DONE, OrderRefund.REFUND_STATE_FAILED),
+        ).select_related('order', 'payment').only(
+            'pk', 'amount', 'info', 'created', 'execution_date', 'order__event_id', 'payment__info'
+        )
+        created = 0
+        for batch in batches(refunds, options['batch_size']):
+            rows = []
+            for r in batch:
+                info = r.payment.info_data if r.payment else {}
+                if 'transact' not in info or 'orderid' not in info:
+                    continue
+                reply = r.info_data
+                rows.append(DIBSTransaction(
+                    kind=DIBSTransaction.KIND_REFUND, refund=r, created=r.execution_date or r.created,
+                    **refund_values(r, info, self.merchant(r.order.event_id, info),
+                                    int(reply['result'][0]) if 'result' in reply else None)
+                ))
+            # Rows stored by callbacks or refunds processed in the meantime are kept.
+            DIBSTransaction.objects.bulk_create(rows, ignore_conflicts=True)
+            created += len(rows)
+        self.stdout.write('Stored {} refund transactions'.format(created))
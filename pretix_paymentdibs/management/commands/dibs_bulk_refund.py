@@ -0,0 +1,154 @@
+import json
+import logging
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Sum
+from django.utils.timezone import now
+from django_scopes import scope, scopes_disabled
+
+from pretix.base.models import Event, OrderPayment, OrderRefund
+from pretix.base.payment import PaymentException
+
+from pretix_paymentdibs.client import TRANSIENT_RESULTS
+from pretix_paymentdibs.payment import DIBS
+from pretix_paymentdibs.utils import RateLimiter
+
+logger = logging.getLogger('pretix.plugins.payment_dibs')
+
+OUTCOME_ACCEPTED = 'accepted'
+OUTCOME_FAILED = 'failed'
+OUTCOME_RETRYABLE = 'retryable'
+OUTCOME_SKIPPED = 'skipped'
+
+# Outcomes that are not attempted again when resuming from a checkpoint.
+FINAL_OUTCOMES = {OUTCOME_ACCEPTED, OUTCOME_FAILED, OUTCOME_SKIPPED}
+
+
+def classify(refund):
+    """Map the state and REFUND_* result of an executed refund to an outcome."""
+    if refund.state == OrderRefund.REFUND_STATE_DONE:
+        return OUTCOME_ACCEPTED, DIBS.REFUND_ACCEPTED
+    info = refund.info_data or {}
+    result = int(info['result'][0]) if 'result' in info else -1
+    # A refund left in transit may have been made together with another one, so it is not tried again.
+    if refund.state == OrderRefund.REFUND_STATE_FAILED and (result in TRANSIENT_RESULTS or result == -1):
+        return OUTCOME_RETRYABLE, result
+    return OUTCOME_FAILED, result
+
+
+def refunded_amount(payment):
+    """The part of a payment that is refunded or being refunded. Refunds still in the created state may never be made."""
+    return payment.refunds.filter(
+        state__in=(OrderRefund.REFUND_STATE_DONE, OrderRefund.REFUND_STATE_TRANSIT),
+    ).aggregate(total=Sum('amount'))['total'] or 0
+
+
+class Command(BaseCommand):
+    help = 'Refund confirmed DIBS payments of an event or a list of payments in bulk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event', help='Event to refund, given as organizer_slug/event_slug')
+        parser.add_argument('--payments', type=int, nargs='+', help='Primary keys of the payments to refund')
+        parser.add_argument('--workers', type=int, default=4, help='Number of concurrent refund calls')
+        parser.add_argument('--rate', type=float, default=2.0, help='Maximum refund calls per second and merchant')
+        parser.add_argument('--checkpoint', required=True,
+                            help='File recording the outcome per payment, used to resume an interrupted run')
+
+    def load_checkpoint(self, path):
+        done = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        done[entry['payment']] = entry['outcome']
+        return done
+
+    def payment_ids(self, options):
+        qs = OrderPayment.objects.filter(provider=DIBS.identifier, state=OrderPayment.PAYMENT_STATE_CONFIRMED)
+        if options['event']:
+            try:
+                organizer, event = options['event'].split('/')
+                event = Event.objects.get(organizer__slug=organizer, slug=event)
+            except (ValueError, Event.DoesNotExist):
+                raise CommandError('Event {} not found.'.format(options['event']))
+            qs = qs.filter(order__event=event)
+        elif options['payments']:
+            qs = qs.filter(pk__in=options['payments'])
+        else:
+            raise CommandError('Either --event or --payments is required.')
+        return qs.order_by('pk').values_list('pk', flat=True).iterator()
+
+    def refund_payment(self, pk):
+        try:
+            return self._refund_payment(pk)
+        except Exception:
+            logger.exception('Could not refund DIBS payment %s', pk)
+            return pk, OUTCOME_RETRYABLE, None
+        finally:
+            connection.close()
+
+    def _refund_payment(self, pk):
+        with scopes_disabled():
+            payment = OrderPayment.objects.select_related('order', 'order__event', 'order__event__organizer').get(pk=pk)
+        with scope(organizer=payment.order.event.organizer):
+            amount = payment.amount - refunded_amount(payment)
+            if amount <= 0:
+                return pk, OUTCOME_SKIPPED, None
+
+            provider = payment.payment_provider
+            self.limiter.wait(provider.merchant_for(payment).merchant_id)
+            refund = payment.order.refunds.create(
+                payment=payment,
+                source=OrderRefund.REFUND_SOURCE_ADMIN,
+                state=OrderRefund.REFUND_STATE_CREATED,
+                amount=amount,
+                provider=payment.provider,
+            )
+            payment.order.log_action('pretix.event.order.refund.created', {
+                'local_id': refund.local_id,
+                'provider': refund.provider,
+            })
+
+            try:
+                provider.execute_refund(refund)
+            except PaymentException:
+                pass
+            except Exception:
+                # E.g. a payment without the stored transaction, which fails the same way when tried again.
+                logger.exception('Could not refund DIBS payment %s', pk)
+                return pk, OUTCOME_FAILED, None
+            finally:
+                # Do not leave a refund behind that was neither made nor failed.
+                OrderRefund.objects.filter(pk=refund.pk, state=OrderRefund.REFUND_STATE_CREATED).update(
+                    state=OrderRefund.REFUND_STATE_FAILED, execution_date=now(),
+                )
+            refund.refresh_from_db()
+            return (pk,) + classify(refund)
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        done = self.load_checkpoint(options['checkpoint'])
+        self.limiter = RateLimiter(options['rate'])
+        summary = Counter()
+        results = Counter()
+
+        todo = (pk for pk in self.payment_ids(options) if done.get(pk) not in FINAL_OUTCOMES)
+        with open(options['checkpoint'], 'a') as checkpoint, ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            for pk, outcome, result in executor.map(self.refund_payment, todo):
+                checkpoint.write(json.dumps({'payment': pk, 'outcome': outcome, 'result': result}) + '\n')
+                checkpoint.flush()
+                summary[outcome] += 1
+                if result is not None:
+                    results[result] += 1
+
+        self.stdout.write('Refunds accepted: {}'.format(summary[OUTCOME_ACCEPTED]))
+        self.stdout.write('Refunds failed: {}'.format(summary[OUTCOME_FAILED]))
+        self.stdout.write('Refunds retryable: {}'.format(summary[OUTCOME_RETRYABLE]))
+        self.stdout.write('Payments skipped (nothing left to refund): {}'.format(summary[OUTCOME_SKIPPED]))
+        for result, count in sorted(results.items()):
+            self.stdout.write('  result {}: {}'.format(result, count))
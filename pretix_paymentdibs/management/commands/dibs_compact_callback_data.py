@@ -0,0 +1,59 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django_scopes import scopes_disabled
+
+from pretix.base.models import LogEntry, OrderPayment
+
+from pretix_paymentdibs.payment import DIBS
+
+
+def batches(qs, batch_size):
+    """Iterate over a queryset in primary key order, one batch at a time."""
+    last = 0
+    while True:
+        batch = list(qs.filter(pk__gt=last).order_by('pk')[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last = batch[-1].pk
+
+
+class Command(BaseCommand):
+    help = 'Remove unused callback parameters from stored DIBS payments and callback log entries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true')
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        payments = OrderPayment.objects.filter(provider=DIBS.identifier).exclude(info__isnull=True).only('pk', 'info')
+        changed = 0
+        for batch in batches(payments, options['batch_size']):
+            update = []
+            for p in batch:
+                info = p.info_data
+                compact = DIBS.compact_payment_info(info)
+                if 'transact' in info and compact != info:
+                    p.info = json.dumps(compact, sort_keys=True)
+                    update.append(p)
+            if update and not options['dry_run']:
+                OrderPayment.objects.bulk_update(update, ['info'])
+            changed += len(update)
+        self.stdout.write('Compacted {} payments'.format(changed))
+
+        entries = LogEntry.objects.filter(action_type='pretix_paymentdibs.callback').only('pk', 'data')
+        changed = 0
+        for batch in batches(entries, options['batch_size']):
+            update = []
+            for e in batch:
+                data = e.parsed_data
+                compact = DIBS.compact_log_data(data)
+                if compact != data:
+                    e.data = json.dumps(compact, sort_keys=True)
+                    update.append(e)
+            if update and not options['dry_run']:
+                LogEntry.objects.bulk_update(update, ['data'])
+            changed += len(update)
+        self.stdout.write('Compacted {} log entries'.format(changed))
@@ -0,0 +1,165 @@
+import csv
+import json
+import mmap
+import multiprocessing
+import os
+from collections import Counter, defaultdict
+from decimal import Decimal, InvalidOperation
+
+from django.core.management.base import BaseCommand, CommandError
+from django_scopes import scopes_disabled
+
+from pretix.base.models import OrderPayment, OrderRefund
+
+from pretix_paymentdibs.payment import DIBS
+
+MATCHED = 'matched'
+MISSING = 'missing'
+AMOUNT_MISMATCH = 'amount_mismatch'
+
+# transact -> [(kind, pk, amount in minor units)], filled before the worker processes are forked
+_index = {}
+
+
+def build_index(payments, refunds):
+    """Map transaction numbers to the payments and refunds carrying them, in a couple of bulk queries."""
+    index = defaultdict(list)
+    for pk, amount, info in payments.values_list('pk', 'amount', 'info').iterator(chunk_size=5000):
+        try:
+            transact = json.loads(info)['transact']
+        except (TypeError, ValueError, KeyError):
+            continue
+        index[str(transact)].append(('payment', pk, int(DIBS.get_amount(amount))))
+    for pk, amount, info in refunds.values_list('pk', 'amount', 'info').iterator(chunk_size=5000):
+        try:
+            transact = json.loads(info)['transact'][0]
+        except (TypeError, ValueError, KeyError, IndexError):
+            continue
+        index[str(transact)].append(('refund', pk, int(DIBS.get_amount(amount))))
+    return dict(index)
+
+
+def chunk_bounds(path, parts):
+    """Split a file into byte ranges that start and end at line boundaries."""
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        bounds = [0]
+        for i in range(1, parts):
+            nl = mm.find(b'\n', max(size * i // parts, bounds[-1]))
+            if nl == -1:
+                break
+            bounds.append(nl + 1)
+        bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def parse_amount(value, minor_units):
+    value = value.strip().replace(',', '.')
+    amount = Decimal(value)
+    return abs(int(amount if minor_units else amount * 100))
+
+
+def match_range(args):
+    path, start, end, options = args
+    counts = Counter()
+    problems = []
+    seen = set()
+    delimiter = options['delimiter'].encode()
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = start
+        if start == 0 and options['header']:
+            pos = mm.find(b'\n', 0, end) + 1 or end
+        while pos < end:
+            nl = mm.find(b'\n', pos, end)
+            line_end = end if nl == -1 else nl
+            line = mm[pos:line_end].rstrip(b'\r')
+            pos = line_end + 1
+            if not line.strip():
+                continue
+            fields = line.split(delimiter)
+            try:
+                transact = fields[options['transact_column']].decode().strip().strip('"')
+                amount = parse_amount(fields[options['amount_column']].decode().strip('"'), options['minor_units'])
+            except (IndexError, UnicodeDecodeError, InvalidOperation):
+                counts['unparseable'] += 1
+                continue
+
+            seen.add(transact)
+            entries = _index.get(transact)
+            if not entries:
+                counts[MISSING] += 1
+                problems.append((MISSING, transact, amount, None))
+            elif any(e[2] == amount for e in entries):
+                counts[MATCHED] += 1
+            else:
+                counts[AMOUNT_MISMATCH] += 1
+                problems.append((AMOUNT_MISMATCH, transact, amount, ' '.join('{}:{}:{}'.format(*e) for e in entries)))
+    return counts, problems, seen
+
+
+class Command(BaseCommand):
+    help = 'Match a DIBS settlement file against the DIBS payments and refunds in pretix'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file')
+        parser.add_argument('--organizer', help='Only match against payments of this organizer (slug)')
+        parser.add_argument('--delimiter', default=';')
+        parser.add_argument('--header', action='store_true', help='The first line is a header')
+        parser.add_argument('--transact-column', type=int, default=0, help='Zero-based column of the transaction number')
+        parser.add_argument('--amount-column', type=int, default=1, help='Zero-based column of the amount')
+        parser.add_argument('--minor-units', action='store_true', help='Amounts are given in minor units, e.g. øre')
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--output', help='Write missing and mismatching rows to this CSV file')
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        global _index
+
+        if not os.path.exists(options['file']):
+            raise CommandError('File {} not found.'.format(options['file']))
+
+        payments = OrderPayment.objects.filter(provider=DIBS.identifier)
+        refunds = OrderRefund.objects.filter(provider=DIBS.identifier)
+        if options['organizer']:
+            payments = payments.filter(order__event__organizer__slug=options['organizer'])
+            refunds = refunds.filter(order__event__organizer__slug=options['organizer'])
+        _index = build_index(payments, refunds)
+        self.stdout.write('Indexed {} transactions'.format(len(_index)))
+
+        worker_options = {
+            k: options[k] for k in ('delimiter', 'header', 'transact_column', 'amount_column', 'minor_units')
+        }
+        jobs = [(options['file'], start, end, worker_options)
+                for start, end in chunk_bounds(options['file'], max(1, options['workers']))]
+
+        # Workers are forked, so they share the index built above without copying it.
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(len(jobs) or 1) as pool:
+            results = pool.map(match_range, jobs)
+
+        counts = Counter()
+        seen = set()
+        problems = []
+        for c, p, s in results:
+            counts.update(c)
+            problems += p
+            seen |= s
+
+        not_settled = sum(
+            1 for transact, entries in _index.items()
+            if transact not in seen and any(kind == 'payment' for kind, _, _ in entries)
+        )
+
+        self.stdout.write('Matched: {}'.format(counts[MATCHED]))
+        self.stdout.write('Missing in pretix: {}'.format(counts[MISSING]))
+        self.stdout.write('Amount mismatch: {}'.format(counts[AMOUNT_MISMATCH]))
+        self.stdout.write('Unparseable lines: {}'.format(counts['unparseable']))
+        self.stdout.write('Payments in pretix not in the settlement file: {}'.format(not_settled))
+
+        if options['output']:
+            with open(options['output'], 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['problem', 'transact', 'amount', 'pretix'])
+                writer.writerows(problems)
@@ -0,0 +1,58 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django_scopes import scope, scopes_disabled
+
+from pretix_paymentdibs.models import ReceivedCallback
+from pretix_paymentdibs.tasks import claim_callback, queue_depth, run_callback
+
+
+def _process(pk):
+    try:
+        if not claim_callback(pk):
+            return None
+        with scopes_disabled():
+            received = ReceivedCallback.objects.select_related('event', 'event__organizer').get(pk=pk)
+        with scope(organizer=received.event.organizer):
+            return run_callback(received.event, received)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Drain the queue of received DIBS callbacks with a pool of workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int,
+            default=settings.CONFIG_FILE.getint('pretix_paymentdibs', 'callback_workers', fallback=4),
+            help='Number of concurrent workers',
+        )
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--loop', action='store_true', help='Keep polling for new callbacks')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when the queue is empty')
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                pks = list(
+                    ReceivedCallback.objects.filter(
+                        state=ReceivedCallback.STATE_PENDING
+                    ).values_list('pk', flat=True)[:options['batch_size']]
+                )
+                results = list(executor.map(_process, pks))
+                if pks:
+                    self.stdout.write('Processed {} callbacks ({} done, {} failed), queue depth {}'.format(
+                        len([r for r in results if r is not None]),
+                        results.count(ReceivedCallback.STATE_DONE),
+                        results.count(ReceivedCallback.STATE_FAILED),
+                        queue_depth(),
+                    ))
+                if not options['loop']:
+                    break
+                if len(pks) < options['batch_size']:
+                    time.sleep(options['interval'])
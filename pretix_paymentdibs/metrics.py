@@ -0,0 +1,133 @@
+import logging
+import socket
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger('pretix.plugins.payment_dibs')
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# name: (type, description, label names)
+METRICS = {
+    'pretix_dibs_callbacks_total': (COUNTER, 'DIBS callbacks processed, by status code.', ['statuscode']),
+    'pretix_dibs_callback_duration_seconds': (HISTOGRAM, 'Time spent processing DIBS callbacks, by stage.', ['stage']),
+    'pretix_dibs_authkey_failures_total': (COUNTER, 'DIBS callbacks with an invalid authkey.', []),
+    'pretix_dibs_refund_duration_seconds': (HISTOGRAM, 'Round-trip time of DIBS refund calls, by result code.', ['result']),
+    'pretix_dibs_refunds_rejected_total': (COUNTER, 'DIBS refunds rejected without calling DIBS, by reason.', ['reason']),
+    'pretix_dibs_callback_queue_depth': (GAUGE, 'DIBS callbacks waiting to be processed.', []),
+    'pretix_dibs_callbacks_rejected_total': (COUNTER, 'DIBS callbacks rejected before processing, by reason.', ['reason']),
+}
+
+
+class NullBackend:
+    def increment(self, name, amount=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def gauge(self, name, value, **labels):
+        pass
+
+
+class PrometheusBackend:
+    """
+    Exposes the metrics through pretix' own metrics endpoint (``/metrics``, cf. ``METRICS_ENABLED``).
+    """
+
+    def __init__(self):
+        from pretix.base import metrics
+
+        types = {COUNTER: metrics.Counter, GAUGE: metrics.Gauge, HISTOGRAM: metrics.Histogram}
+        self.metrics = {
+            name: types[kind](name, description, labelnames)
+            for name, (kind, description, labelnames) in METRICS.items()
+        }
+
+    def increment(self, name, amount=1, **labels):
+        self.metrics[name].inc(amount, **labels)
+
+    def observe(self, name, value, **labels):
+        self.metrics[name].observe(value, **labels)
+
+    def gauge(self, name, value, **labels):
+        self.metrics[name].set(value, **labels)
+
+
+class StatsdBackend:
+    """
+    Sends the metrics to a statsd server over UDP, with labels as DogStatsD-style tags.
+    """
+
+    def __init__(self, host, port, prefix):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, name, value, kind, labels):
+        line = '{}{}:{}|{}'.format(self.prefix, name, value, kind)
+        if labels:
+            line += '|#' + ','.join('{}:{}'.format(k, v) for k, v in sorted(labels.items()))
+        try:
+            self.socket.sendto(line.encode(), self.address)
+        except OSError:
+            logger.warning('Could not send metric %s to statsd', name)
+
+    def increment(self, name, amount=1, **labels):
+        self.send(name, amount, 'c', labels)
+
+    def observe(self, name, value, **labels):
+        self.send(name, round(value * 1000, 3), 'ms', labels)
+
+    def gauge(self, name, value, **labels):
+        self.send(name, value, 'g', labels)
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        kind = settings.CONFIG_FILE.get('pretix_paymentdibs', 'metrics', fallback='prometheus')
+        if kind == 'statsd':
+            _backend = StatsdBackend(
+                settings.CONFIG_FILE.get('pretix_paymentdibs', 'statsd_host', fallback='127.0.0.1'),
+                settings.CONFIG_FILE.getint('pretix_paymentdibs', 'statsd_port', fallback=8125),
+                settings.CONFIG_FILE.get('pretix_paymentdibs', 'statsd_prefix', fallback=''),
+            )
+        elif kind == 'prometheus':
+            _backend = PrometheusBackend()
+        else:
+            _backend = NullBackend()
+    return _backend
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+
+def increment(name, amount=1, **labels):
+    get_backend().increment(name, amount, **labels)
+
+
+def observe(name, value, **labels):
+    get_backend().observe(name, value, **labels)
+
+
+def gauge(name, value, **labels):
+    get_backend().gauge(name, value, **labels)
+
+
+@contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
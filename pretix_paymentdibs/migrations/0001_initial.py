@@ -0,0 +1,35 @@
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('pretixbase', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReceivedCallback',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('payment_id', models.PositiveIntegerField(null=True)),
+                ('parameters', models.JSONField()),
+                ('state', models.CharField(choices=[('pending', 'pending'), ('processing', 'processing'), ('done', 'done'),
+                                                    ('failed', 'failed')], db_index=True, default='pending', max_length=16)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('received', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('claimed', models.DateTimeField(null=True)),
+                ('processed', models.DateTimeField(null=True)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dibs_callbacks',
+                                            to='pretixbase.event')),
+            ],
+            options={
+                'ordering': ('received',),
+            },
+        ),
+    ]
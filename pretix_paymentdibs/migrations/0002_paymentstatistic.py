@@ -0,0 +1,31 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretixbase', '0001_initial'),
+        ('pretix_paymentdibs', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentStatistic',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('date', models.DateField()),
+                ('kind', models.CharField(choices=[('statuscode', 'statuscode'), ('paytype', 'paytype'),
+                                                   ('card_type', 'card_type'), ('refund_result', 'refund_result')],
+                                          max_length=16)),
+                ('value', models.CharField(max_length=32)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dibs_statistics',
+                                            to='pretixbase.event')),
+            ],
+            options={
+                'ordering': ('date', 'kind', 'value'),
+                'unique_together': {('event', 'date', 'kind', 'value')},
+            },
+        ),
+    ]
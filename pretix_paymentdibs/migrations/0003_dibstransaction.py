@@ -0,0 +1,37 @@
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretixbase', '0001_initial'),
+        ('pretix_paymentdibs', '0002_paymentstatistic'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DIBSTransaction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('payment', 'payment'), ('refund', 'refund')], max_length=16)),
+                ('transact', models.CharField(db_index=True, max_length=20)),
+                ('orderid', models.CharField(db_index=True, max_length=255)),
+                ('merchant', models.CharField(db_index=True, max_length=64)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=13)),
+                ('statuscode', models.SmallIntegerField(db_index=True, null=True)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated', models.DateTimeField(default=django.utils.timezone.now)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dibs_transactions',
+                                            to='pretixbase.event')),
+                ('payment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                              related_name='dibs_transactions', to='pretixbase.orderpayment')),
+                ('refund', models.OneToOneField(null=True, on_delete=django.db.models.deletion.CASCADE,
+                                                related_name='dibs_transaction', to='pretixbase.orderrefund')),
+            ],
+            options={
+                'ordering': ('created',),
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations, models
+
+
+def delete_duplicates(apps, schema_editor):
+    DIBSTransaction = apps.get_model('pretix_paymentdibs', 'DIBSTransaction')
+    duplicated = DIBSTransaction.objects.filter(kind='payment').values('payment_id').annotate(
+        n=models.Count('id')
+    ).filter(n__gt=1).values_list('payment_id', flat=True)
+    for payment_id in duplicated:
+        rows = DIBSTransaction.objects.filter(kind='payment', payment_id=payment_id).order_by('-updated', '-id')
+        DIBSTransaction.objects.filter(pk__in=list(rows.values_list('pk', flat=True)[1:])).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_paymentdibs', '0003_dibstransaction'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='dibstransaction',
+            constraint=models.UniqueConstraint(condition=models.Q(kind='payment'), fields=('payment',),
+                                               name='pretix_paymentdibs_one_transaction_per_payment'),
+        ),
+    ]
@@ -0,0 +1,97 @@
+from django.db import models
+from django.utils.timezone import now
+
+
+class ReceivedCallback(models.Model):
+    """
+    Raw DIBS callback parameters waiting to be processed by a worker.
+    """
+    STATE_PENDING = 'pending'
+    STATE_PROCESSING = 'processing'
+    STATE_DONE = 'done'
+    STATE_FAILED = 'failed'
+
+    STATE_CHOICES = (
+        (STATE_PENDING, STATE_PENDING),
+        (STATE_PROCESSING, STATE_PROCESSING),
+        (STATE_DONE, STATE_DONE),
+        (STATE_FAILED, STATE_FAILED),
+    )
+
+    event = models.ForeignKey('pretixbase.Event', on_delete=models.CASCADE, related_name='dibs_callbacks')
+    payment_id = models.PositiveIntegerField(null=True)
+    parameters = models.JSONField()
+    state = models.CharField(max_length=16, choices=STATE_CHOICES, default=STATE_PENDING, db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+    received = models.DateTimeField(default=now, db_index=True)
+    claimed = models.DateTimeField(null=True)
+    processed = models.DateTimeField(null=True)
+
+    class Meta:
+        ordering = ('received',)
+
+
+class PaymentStatistic(models.Model):
+    """
+    Number of DIBS callbacks and refunds of an event on one day, by status code,
+    payment type, card type or refund result. Updated as callbacks and refunds
+    are processed, cf. statistics.py.
+    """
+    KIND_STATUSCODE = 'statuscode'
+    KIND_PAYTYPE = 'paytype'
+    KIND_CARD_TYPE = 'card_type'
+    KIND_REFUND_RESULT = 'refund_result'
+
+    KIND_CHOICES = (
+        (KIND_STATUSCODE, KIND_STATUSCODE),
+        (KIND_PAYTYPE, KIND_PAYTYPE),
+        (KIND_CARD_TYPE, KIND_CARD_TYPE),
+        (KIND_REFUND_RESULT, KIND_REFUND_RESULT),
+    )
+
+    event = models.ForeignKey('pretixbase.Event', on_delete=models.CASCADE, related_name='dibs_statistics')
+    date = models.DateField()
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    value = models.CharField(max_length=32)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('event', 'date', 'kind', 'value'),)
+        ordering = ('date', 'kind', 'value')
+
+
+class DIBSTransaction(models.Model):
+    """
+    The DIBS transaction of a payment or refund, so it can be found by its DIBS
+    identifiers without looking into the stored payment info. Kept up to date
+    as callbacks and refunds are processed, cf. transactions.py.
+    """
+    KIND_PAYMENT = 'payment'
+    KIND_REFUND = 'refund'
+
+    KIND_CHOICES = (
+        (KIND_PAYMENT, KIND_PAYMENT),
+        (KIND_REFUND, KIND_REFUND),
+    )
+
+    event = models.ForeignKey('pretixbase.Event', on_delete=models.CASCADE, related_name='dibs_transactions')
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    payment = models.ForeignKey('pretixbase.OrderPayment', on_delete=models.CASCADE, related_name='dibs_transactions')
+    refund = models.OneToOneField('pretixbase.OrderRefund', on_delete=models.CASCADE, null=True,
+                                  related_name='dibs_transaction')
+    transact = models.CharField(max_length=20, db_index=True)
+    orderid = models.CharField(max_length=255, db_index=True)
+    merchant = models.CharField(max_length=64, db_index=True)
+    amount = models.DecimalField(max_digits=13, decimal_places=2)
+    # Last status code reported for a payment, result code of a refund
+    statuscode = models.SmallIntegerField(null=True, db_index=True)
+    created = models.DateTimeField(default=now)
+    updated = models.DateTimeField(default=now)
+
+    class Meta:
+        ordering = ('created',)
+        constraints = [
+            models.UniqueConstraint(fields=['payment'], condition=models.Q(kind='payment'),
+                                    name='pretix_paymentdibs_one_transaction_per_payment'),
+        ]
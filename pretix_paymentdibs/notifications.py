@@ -0,0 +1,28 @@
+from django.utils.translation import gettext_lazy as _
+
+from pretix.base.notifications import Notification, NotificationType
+from pretix.helpers.urls import build_absolute_uri
+
+
+class CaptureFailedNotificationType(NotificationType):
+    action_type = 'pretix_paymentdibs.capture.failed'
+    verbose_name = _('DIBS payment could not be captured')
+    required_permission = 'can_view_orders'
+
+    def build_notification(self, logentry):
+        order = logentry.content_object
+        order_url = build_absolute_uri('control:event.order', kwargs={
+            'organizer': logentry.event.organizer.slug,
+            'event': logentry.event.slug,
+            'code': order.code,
+        })
+        n = Notification(
+            event=logentry.event,
+            title=_('The DIBS payment of order {code} could not be captured').format(code=order.code),
+            detail=_('The order is marked as paid, but the money has not been collected. Please check the payment in '
+                     'the DIBS administration and contact the customer if necessary.'),
+            url=order_url,
+        )
+        n.add_attribute(_('Result code'), str(logentry.parsed_data.get('result')))
+        n.add_action(_('View order details'), order_url)
+        return n
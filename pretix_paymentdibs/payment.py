@@ -1,27 +1,125 @@
 import hashlib
 import json
 import logging
+import random
 import re
+import time
 from collections import OrderedDict
-from urllib.parse import parse_qs
+from decimal import Decimal
+from typing import NamedTuple, Optional
+from urllib.parse import urlencode
 
-import pycountry
-import requests
 from django import forms
-from django.contrib import messages
+from django.core import signing
+from django.core.cache import cache
+from django.db.models import Sum
 from django.template.loader import get_template
+from django.utils.functional import cached_property
 from django.utils.timezone import now
-from django.utils.translation import gettext_lazy as _
+from django.utils.translation import get_language, gettext_lazy as _
 
 from pretix.base.forms import SecretKeySettingsField
-from pretix.base.models import Event, Order, Organizer, OrderPayment, Quota, OrderRefund
+from pretix.base.models import Event, OrderPayment, Quota, OrderRefund
 from pretix.base.payment import BasePaymentProvider, PaymentException
-from pretix.base.services.mail import SendMailException
-from pretix.base.services.orders import mark_order_paid
 from pretix.multidomain.urlreverse import build_absolute_uri
 
+from . import hashing, metrics, statistics, transactions
+from .currencies import ALPHA_3_CODES, get_alpha_3_code, get_numeric_code
+from .utils import cache_key, cache_lock, compact_callback_log_enabled
+
 logger = logging.getLogger('pretix.plugins.payment_dibs')
 
+# Seconds a single callback may hold the per-payment lock, and seconds another callback waits for it.
+CALLBACK_LOCK_TIMEOUT = 30
+CALLBACK_LOCK_WAIT = 10
+# Seconds the result of a processed callback is remembered for duplicates.
+CALLBACK_RESULT_TIMEOUT = 300
+# Seconds a refund may hold the per-payment refund lock, and seconds a refund waits for it.
+REFUND_LOCK_TIMEOUT = 120
+REFUND_LOCK_WAIT = 60
+# Seconds a waiting refund stays announced after its caller last polled for the lock.
+REFUND_WAITING_TIMEOUT = 5
+# Seconds the settings snapshot of an event is cached.
+CONFIG_CACHE_TIMEOUT = 3600
+# Seconds the rendered payment details of the control panel are cached.
+CONTROL_RENDER_CACHE_TIMEOUT = 24 * 3600
+# Expected format of callback parameters, cf. DIBS.check_callback_parameters
+CALLBACK_PARAMETER_PATTERNS = {
+    'orderid': re.compile(r'^[^/]{1,64}/[^/]{1,64}/[A-Z0-9]{1,16}/[0-9]{1,9}$'),
+    'transact': re.compile(r'^[0-9]{1,20}$'),
+    'statuscode': re.compile(r'^[0-9]{1,3}$'),
+    'currency': re.compile(r'^[0-9]{3}$'),
+    'amount': re.compile(r'^[0-9]{1,12}$'),
+    'authkey': re.compile(r'^[0-9a-f]{32}$'),
+}
+REQUIRED_CALLBACK_PARAMETERS = {'orderid', 'transact', 'statuscode', 'currency'}
+# Signed payment info tokens, cf. DIBS.set_payment_info
+PAYMENT_INFO_SALT = 'pretix_paymentdibs.payment_info'
+PAYMENT_INFO_MAX_AGE = 24 * 3600
+
+
+class CallbackBusy(Exception):
+    """Another callback for the same payment is being processed, the callback must be delivered again."""
+
+
+class Merchant(NamedTuple):
+    merchant_id: str
+    md5_key1: Optional[str]
+    md5_key2: Optional[str]
+    weight: int = 1
+    currency: Optional[str] = None
+
+
+def parse_merchants(value):
+    """
+    Parse the additional merchants setting, one merchant per line as
+    ``merchant_id;md5_key1;md5_key2[;weight[;currency]]``.
+    """
+    merchants = []
+    for line in (value or '').splitlines():
+        if not line.strip():
+            continue
+        fields = [f.strip() for f in line.split(';')]
+        if len(fields) < 3 or len(fields) > 5 or not fields[0]:
+            raise ValueError(line)
+        weight = fields[3] if len(fields) > 3 and fields[3] else '1'
+        currency = fields[4].upper() if len(fields) > 4 and fields[4] else None
+        if not weight.isdigit() or any(len(key) != 32 for key in fields[1:3]):
+            raise ValueError(line)
+        merchants.append(Merchant(fields[0], fields[1], fields[2], int(weight), currency))
+    return merchants
+
+
+def validate_merchants(value):
+    try:
+        parse_merchants(value)
+    except ValueError as e:
+        raise forms.ValidationError(_('Invalid merchant: {line}').format(line=str(e).split(';')[0]))
+
+
+class DIBSConfig(NamedTuple):
+    merchant_id: Optional[str]
+    md5_key1: Optional[str]
+    md5_key2: Optional[str]
+    test_mode: bool
+    decorator: Optional[str]
+    api_user: Optional[str]
+    api_password: Optional[str]
+    stateless_checkout: bool
+    capture_now: bool
+    # All merchants payments can be routed to, the one above first
+    merchants: tuple
+    merchant_routing: str
+
+
+def refund_waiting_key(payment_id, refund_id):
+    return cache_key('refund_waiting', payment_id, refund_id)
+
+
+def config_cache_key(event_id):
+    # Snapshots cached by a version with other fields can not be unpickled.
+    return cache_key('config', event_id, ','.join(DIBSConfig._fields))
+
 
 class DIBS(BasePaymentProvider):
     identifier = 'dibs'
@@ -119,6 +217,8 @@ class DIBS(BasePaymentProvider):
             'V-DK',         # VISA-Dankort
         ]
     }
+    # Reverse index of CARD_TYPES: paytype -> card type
+    PAYTYPE_CARD_TYPES = {paytype: card_type for card_type, paytypes in CARD_TYPES.items() for paytype in paytypes}
 
     # https://tech.dibspayment.com/nodeaddpage/toolboxstatuscodes
     STATUS_CODE_TRANSACTION_INSERTED = 0
@@ -143,6 +243,39 @@ class DIBS(BasePaymentProvider):
     STATUS_CODE_MULTICAP_TRANSACTION_CLOSED = 19
     STATUS_CODE_POSTPONED = 26
 
+    # Status codes for which a payment is confirmed
+    CONFIRMED_STATUS_CODES = {
+        STATUS_CODE_AUTHORIZATION_APPROVED,
+        STATUS_CODE_CAPTURE_COMPLETED,
+        STATUS_CODE_CAPTURE_PENDING,
+        STATUS_CODE_MULTICAP_TRANSACTION_OPEN,
+        STATUS_CODE_MULTICAP_TRANSACTION_CLOSED,
+    }
+    # Status codes of transactions that are authorised, but not captured yet
+    AUTHORISED_STATUS_CODES = {
+        STATUS_CODE_AUTHORIZATION_APPROVED,
+        STATUS_CODE_MULTICAP_TRANSACTION_OPEN,
+    }
+    # Status codes of transactions whose capture has been made or handed to the acquirer
+    CAPTURED_STATUS_CODES = {
+        STATUS_CODE_CAPTURE_SENT_TO_ACQUIRER,
+        STATUS_CODE_CAPTURE_COMPLETED,
+        STATUS_CODE_CAPTURE_PENDING,
+        STATUS_CODE_MULTICAP_TRANSACTION_CLOSED,
+    }
+    # Status codes for which a payment attempt failed
+    DECLINED_STATUS_CODES = {
+        STATUS_CODE_DECLINED,
+        STATUS_CODE_CAPTURE_DECLINED_BY_ACQUIRER,
+        STATUS_CODE_DECLINED_BY_DIBS,
+    }
+
+    # Values of info_data['capture'] for payments authorised without capture
+    CAPTURE_PENDING = 'pending'
+    CAPTURE_DONE = 'done'
+    CAPTURE_FAILED = 'failed'
+    CAPTURE_SKIPPED = 'skipped'
+
     # https://tech.dibspayment.com/D2/API/Error_codes
     REFUND_ACCEPTED = 0
     REFUND_NO_RESPONSE_FROM_ACQUIRER = 1
@@ -160,6 +293,18 @@ class DIBS(BasePaymentProvider):
     REFUND_CAPTURE_IS_CALLED_FOR_A_TRANSACTION_WHICH_IS_PENDING_FOR_BATCH_I_E_CAPTURE_WAS_ALREADY_CALLED = 14
     REFUND_CAPTURE_OR_REFUND_WAS_BLOCKED_BY_DIBS = 15
 
+    # https://tech.dibspayment.com/D2/Hosted/Output_parameters/Return_parameters
+    # Callback parameters stored on the payment. orderid and currency are needed for refunds, authkey, amount and
+    # currency_code to audit callbacks later (cf. the dibs_audit_callbacks command).
+    CALLBACK_FIELDS = (
+        'orderid', 'transact', 'paytype', 'cardnomask', 'cardexpdate', 'cardcountry', 'statuscode', 'currency',
+        'currency_code', 'amount', 'authkey',
+    )
+    # Fields set by the plugin itself, stored on the payment next to CALLBACK_FIELDS.
+    PAYMENT_INFO_FIELDS = ('merchant', 'capture', 'capture_result')
+    # Callback parameters stored in log entries if compact_callback_log is enabled.
+    CALLBACK_LOG_FIELDS = ('transact', 'statuscode', 'amount', 'currency_code', 'authkey', 'merchant')
+
     @property
     def settings_form_fields(self):
         d = OrderedDict([
@@ -202,6 +347,27 @@ class DIBS(BasePaymentProvider):
                      parent_control=_('MD5-control of payments')
                  )
              )),
+            ('additional_merchants',
+             forms.CharField(
+                 label=_('Additional merchants'),
+                 widget=forms.Textarea(attrs={'rows': 3}),
+                 required=False,
+                 validators=[validate_merchants],
+                 help_text=_('Spread payments over several DIBS merchant accounts. One merchant per line as '
+                             '"merchant id;MD5 key 1;MD5 key 2", optionally followed by ";weight;currency". '
+                             'The API user must have access to all of them.')
+             )),
+            ('merchant_routing',
+             forms.ChoiceField(
+                 label=_('Merchant selection'),
+                 choices=(
+                     ('round_robin', _('Round robin')),
+                     ('weighted', _('Random, by weight')),
+                     ('currency', _('By currency, round robin between merchants for the same currency')),
+                 ),
+                 initial='round_robin',
+                 required=False,
+             )),
             ('decorator',
              forms.ChoiceField(
                  label=_('Payment page design'),
@@ -216,6 +382,17 @@ class DIBS(BasePaymentProvider):
                      docs_url='https://tech.dibspayment.com/D2/Hosted/Input_parameters/Standard'
                  )
              )),
+            ('capture_mode',
+             forms.ChoiceField(
+                 label=_('Capture'),
+                 choices=(
+                     ('now', _('Capture immediately')),
+                     ('deferred', _('Only authorise the payment, capture it in the background')),
+                 ),
+                 initial='now',
+                 help_text=_('Deferred capture requires the API user to be set. Authorisations of orders that are '
+                             'canceled before they are captured are not captured.')
+             )),
             ('api_user',
              forms.CharField(
                  label=_('API Username'),
@@ -232,12 +409,55 @@ class DIBS(BasePaymentProvider):
                      docs_url='https://tech.dibspayment.com/D2/Hosted/Input_parameters/Standard'
                  )
              )),
+            ('stateless_checkout',
+             forms.BooleanField(
+                 label=_('Stateless checkout'),
+                 required=False,
+                 initial=False,
+                 help_text=_('If checked, the payment details are passed to and from DIBS in signed links instead of '
+                             'being stored in the customer\'s session.')
+             )),
 
         ] + list(super().settings_form_fields.items()))
         d.move_to_end('_enabled', last=False)
 
         return d
 
+    @cached_property
+    def config(self) -> DIBSConfig:
+        """
+        All DIBS settings of the event, read in one go.
+
+        The snapshot is shared between requests through the cache and dropped
+        whenever one of the provider's settings is changed (cf. signals.py).
+        """
+        key = config_cache_key(self.event.pk)
+        config = cache.get(key)
+        if config is None:
+            merchant_id = self.settings.get('merchant_id')
+            md5_key1 = self.settings.get('md5_key1')
+            md5_key2 = self.settings.get('md5_key2')
+            try:
+                additional = parse_merchants(self.settings.get('additional_merchants'))
+            except ValueError:
+                logger.warning('Invalid additional DIBS merchants for event %s', self.event.pk)
+                additional = []
+            config = DIBSConfig(
+                merchant_id=merchant_id,
+                md5_key1=md5_key1,
+                md5_key2=md5_key2,
+                test_mode=self.settings.get('test_mode', as_type=bool, default=False),
+                decorator=self.settings.get('decorator'),
+                api_user=self.settings.get('api_user'),
+                api_password=self.settings.get('api_password'),
+                stateless_checkout=self.settings.get('stateless_checkout', as_type=bool, default=False),
+                capture_now=self.settings.get('capture_mode', default='now') != 'deferred',
+                merchants=tuple([Merchant(merchant_id, md5_key1, md5_key2)] + additional),
+                merchant_routing=self.settings.get('merchant_routing', default='round_robin'),
+            )
+            cache.set(key, config, CONFIG_CACHE_TIMEOUT)
+        return config
+
     def payment_is_valid_session(self, request):
         return True
 
@@ -276,8 +496,119 @@ class DIBS(BasePaymentProvider):
         return all(self.get_api_authorization())
 
     def execute_refund(self, refund):
+        # Refunds of one transaction are made one at a time, parallel calls would race each other at DIBS.
+        key = cache_key('refund_lock', refund.payment.pk)
+        # Refunds waiting for the lock announce themselves, so the lock holder may make them too, cf. _coalesce_refunds
+        waiting_key = refund_waiting_key(refund.payment.pk, refund.pk)
+        deadline = time.monotonic() + REFUND_LOCK_WAIT
+        try:
+            while True:
+                with cache_lock(key, REFUND_LOCK_TIMEOUT) as acquired:
+                    if acquired:
+                        cache.delete(waiting_key)
+                        return self._execute_refund(refund)
+                cache.set(waiting_key, True, REFUND_WAITING_TIMEOUT)
+                if time.monotonic() > deadline and self._withdraw_refund(refund):
+                    raise PaymentException(_('Another refund of this payment is in progress, please try again.'))
+                time.sleep(0.2)
+        finally:
+            cache.delete(waiting_key)
+
+    @staticmethod
+    def _withdraw_refund(refund):
+        """
+        Give up waiting for the lock. Returns False if the lock holder already
+        took the refund over, in which case the caller must wait for it.
+        """
+        return OrderRefund.objects.filter(
+            pk=refund.pk, state=OrderRefund.REFUND_STATE_CREATED,
+        ).update(state=OrderRefund.REFUND_STATE_FAILED, execution_date=now()) == 1
+
+    @staticmethod
+    def _fail_refund(refund):
+        refund.state = OrderRefund.REFUND_STATE_FAILED
+        refund.execution_date = now()
+        refund.save()
+
+    @staticmethod
+    def refundable_amount(payment):
+        """The part of a payment that has not been refunded through DIBS yet."""
+        refunded = payment.refunds.filter(
+            provider=DIBS.identifier, state=OrderRefund.REFUND_STATE_DONE,
+        ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
+        return payment.amount - refunded
+
+    def _coalesce_refunds(self, refund, refundable):
+        """
+        The refund plus other refunds of the same payment whose callers are waiting
+        for the lock, as long as they fit into the refundable amount. They are all
+        made with a single call.
+
+        The other refunds are taken over by moving them to the transit state,
+        which their callers see when they stop waiting.
+        """
+        refunds = [refund]
+        total = refund.amount
+        candidates = list(refund.payment.refunds.filter(
+            provider=DIBS.identifier, state=OrderRefund.REFUND_STATE_CREATED,
+        ).exclude(pk=refund.pk).order_by('pk'))
+        waiting = cache.get_many([refund_waiting_key(refund.payment.pk, r.pk) for r in candidates])
+        for r in candidates:
+            if refund_waiting_key(refund.payment.pk, r.pk) not in waiting or total + r.amount > refundable:
+                continue
+            if OrderRefund.objects.filter(pk=r.pk, state=OrderRefund.REFUND_STATE_CREATED).update(
+                    state=OrderRefund.REFUND_STATE_TRANSIT) == 1:
+                refunds.append(r)
+                total += r.amount
+        return refunds, total
+
+    def _execute_refund(self, refund):
+        refund.refresh_from_db()
+        if refund.state == OrderRefund.REFUND_STATE_DONE:
+            # Made together with another refund of the payment, cf. _coalesce_refunds
+            return
+        if refund.state == OrderRefund.REFUND_STATE_FAILED:
+            raise PaymentException(_('Error refunding in DIBS ({result})').format(
+                result=(refund.info_data.get('result') or ['-'])[0]))
+        if refund.state == OrderRefund.REFUND_STATE_TRANSIT:
+            # Taken over by a refund whose processing broke off, it may or may not have been made.
+            logger.error('DIBS refund %s was left in transit', refund.pk)
+            raise PaymentException(_('This refund may have been made together with another refund of the payment. '
+                                     'Please check the transaction in the DIBS administration.'))
+
+        payment = refund.payment
+        payment.refresh_from_db(fields=['info'])
+        capture = payment.info_data.get('capture')
+        if capture == DIBS.CAPTURE_PENDING:
+            # refund.cgi rejects transactions that are only authorised, cf. capture.py
+            DIBS._fail_refund(refund)
+            raise PaymentException(_('This payment has only been authorised so far. It can be refunded through DIBS '
+                                     'once it has been captured.'))
+        if capture in (DIBS.CAPTURE_FAILED, DIBS.CAPTURE_SKIPPED):
+            # No money was collected and the authorisation lapses, so there is nothing to send back.
+            refund.info_data = {'capture': capture}
+            refund.done()
+            return
+
+        refundable = DIBS.refundable_amount(refund.payment)
+        if refund.amount > refundable:
+            DIBS._fail_refund(refund)
+            raise PaymentException(_('Only {amount} of this payment can be refunded.').format(amount=refundable))
+        refunds, amount = self._coalesce_refunds(refund, refundable)
+        try:
+            self._send_refund(refund, refunds, amount)
+        except BaseException:
+            # The refunds that were taken over go back to their own callers.
+            OrderRefund.objects.filter(
+                pk__in=[r.pk for r in refunds[1:]], state=OrderRefund.REFUND_STATE_TRANSIT,
+            ).update(state=OrderRefund.REFUND_STATE_CREATED)
+            raise
+
+    def _send_refund(self, refund, refunds, amount):
         info = refund.payment.info_data
-        merchant = self.settings.get('merchant_id')
+        config = self.config
+        account = self.merchant_for(refund.payment)
+        merchant = account.merchant_id
         transact = info['transact']
         currency = info['currency']
         orderid = info['orderid']
@@ -285,66 +616,137 @@ class DIBS(BasePaymentProvider):
         payload = {
             'merchant': merchant,
             'transact': transact,
-            'amount': DIBS.get_amount(refund.amount),
+            'amount': DIBS.get_amount(amount),
             'currency': currency,
             'orderid': orderid,
             'textreply': 'true',
             # 'fullreply': 'true'
         }
 
-        if self.settings.get('test_mode'):
+        if config.test_mode:
             payload['test'] = 1
 
         # https://tech.dibspayment.com/D2/API/MD5
-        key1 = self.settings.get('md5_key1')
-        key2 = self.settings.get('md5_key2')
+        key1 = account.md5_key1
+        key2 = account.md5_key2
 
-        parameters = 'merchant=' + merchant + '&orderid=' + orderid + '&transact=' + transact + '&amount=' + DIBS.get_amount(refund.amount)
-        md5key = DIBS.md5(key2 + DIBS.md5(key1 + parameters))
-        payload['md5key'] = md5key
+        payload['md5key'] = hashing.refund_md5key(key1, key2, merchant, orderid, transact, DIBS.get_amount(amount))
 
         (username, password) = self.get_api_authorization()
         if username is None or password is None:
+            DIBS._fail_refund(refund)
             raise PaymentException(_('Missing DIBS api username and password for merchant {merchant}.'
                                      ' Order cannot be refunded in DIBS.').format(merchant=merchant))
 
-        # https://tech.dibspayment.com/D2/API/Payment_functions/refundcgi
-        url = 'https://{}:{}@payment.architrade.com/cgi-adm/refund.cgi'.format(username, password)
+        # Only load the HTTP client stack once a refund is actually made.
+        import requests
 
-        r = requests.post(url, data=payload)
+        from .circuitbreaker import CircuitOpenError
+        from .client import get_client
+
+        start = time.perf_counter()
+        try:
+            data = get_client().refund(payload, auth=(username, password))
+        except CircuitOpenError:
+            metrics.increment('pretix_dibs_refunds_rejected_total', reason='circuit_open')
+            statistics.record_refund(self.event, 'circuit_open')
+            DIBS._fail_refund(refund)
+            raise PaymentException(_('DIBS is currently not responding properly, refunds are paused to protect the '
+                                     'system. Please try again in a few minutes.'))
+        except requests.RequestException as e:
+            metrics.observe('pretix_dibs_refund_duration_seconds', time.perf_counter() - start, result='error')
+            statistics.record_refund(self.event, 'error')
+            logger.exception('Error communicating with DIBS')
+            # Only this refund failed, the others have not been tried and are made by their own callers.
+            DIBS._fail_refund(refund)
+            raise PaymentException(_('Error communicating with DIBS ({message})').format(message=str(e)))
 
-        data = parse_qs(r.text)
         status = data['status'][0] if 'status' in data else None
         result = int(data['result'][0]) if 'result' in data else -1
         message = data['message'][0] if 'message' in data else None
-        refund.info_data = data
+        metrics.observe('pretix_dibs_refund_duration_seconds', time.perf_counter() - start, result=result)
+        statistics.record_refund(self.event, result)
 
         if result == DIBS.REFUND_ACCEPTED:
-            refund.done()
+            for r in refunds:
+                r.info_data = data
+                try:
+                    r.done()
+                except Exception:
+                    # The money has been refunded, do not let one refund keep the others from being marked done.
+                    logger.exception('Could not mark DIBS refund %s as done', r.pk)
+                transactions.record_refund(r, info, merchant, result)
         else:
-            refund.state = OrderRefund.REFUND_STATE_FAILED
-            refund.execution_date = now()
-            refund.save()
+            # Only mark this refund failed, the others are tried again by their own callers.
+            transactions.record_refund(refund, info, merchant, result)
+            refund.info_data = data
+            DIBS._fail_refund(refund)
             raise PaymentException(_('Error refunding in DIBS ({status}; {result}; {message})'.format(status=status, result=result, message=message.strip() if message else '')))
 
-    def get_api_authorization(self):
-        return self.settings.get('api_user'), self.settings.get('api_password')
+    def settings_content_render(self, request):
+        from .client import get_breaker
 
-    def payment_control_render(self, request, payment) -> str:
-        template = get_template('pretix_paymentdibs/control.html')
+        template = get_template('pretix_paymentdibs/settings_content.html')
         ctx = {
             'request': request,
             'event': self.event,
-            'settings': self.settings,
-            'payment_info': payment.info_data,
-            'payment': payment,
-            'provider': self,
+            'api_health': get_breaker().stats(),
         }
         return template.render(ctx)
 
+    def choose_merchant(self):
+        """Pick the merchant for a new payment, cf. the merchant_routing setting."""
+        config = self.config
+        merchants = config.merchants
+        if config.merchant_routing == 'currency':
+            merchants = ([m for m in merchants if m.currency == self.event.currency]
+                         or [m for m in merchants if m.currency is None] or merchants)
+        if len(merchants) == 1:
+            return merchants[0]
+        if config.merchant_routing == 'weighted' and any(m.weight for m in merchants):
+            return random.choices(merchants, weights=[m.weight for m in merchants])[0]
+        key = cache_key('merchant_round_robin', self.event.pk)
+        cache.add(key, 0, None)
+        try:
+            n = cache.incr(key)
+        except ValueError:
+            n = 0
+        return merchants[n % len(merchants)]
+
+    def merchant_for(self, payment):
+        """The merchant a payment was made with, so it is verified and refunded with the right keys."""
+        merchant_id = (payment.info_data or {}).get('merchant')
+        for merchant in self.config.merchants:
+            if merchant.merchant_id == merchant_id:
+                return merchant
+        if merchant_id is not None:
+            logger.warning('DIBS merchant %s of payment %s is no longer configured', merchant_id, payment.pk)
+        return self.config.merchants[0]
+
+    def get_api_authorization(self):
+        return self.config.api_user, self.config.api_password
+
+    def payment_control_render(self, request, payment) -> str:
+        # The stored info is part of the key, so changing it invalidates the cached output.
+        key = cache_key('control', payment.pk, get_language(), payment.info)
+        html = cache.get(key)
+        if html is None:
+            template = get_template('pretix_paymentdibs/control.html')
+            ctx = {
+                'request': request,
+                'event': self.event,
+                'settings': self.settings,
+                'payment_info': payment.info_data,
+                'payment': payment,
+                'provider': self,
+            }
+            html = template.render(ctx)
+            cache.set(key, html, CONTROL_RENDER_CACHE_TIMEOUT)
+        return html
+
     @property
     def currency_code(self):
-        return str(pycountry.currencies.get(alpha_3=self.event.currency).numeric)
+        return get_numeric_code(self.event.currency)
 
     @staticmethod
     def get_amount(total):
@@ -357,117 +759,298 @@ class DIBS(BasePaymentProvider):
         """
         return self.event.organizer.slug + '/' + self.event.slug + '/' + payment.order.code + '/' + str(payment.local_id)
 
+    @staticmethod
+    def get_card_type(paytype):
+        """
+        Get the card type of a DIBS paytype, "credit","debit" or None.
+        """
+        return DIBS.PAYTYPE_CARD_TYPES.get(paytype)
+
     @staticmethod
     def get_payment_card_type(order):
         """
         Get the payment card type, "credit","debit" or None.
         """
         info = json.loads(order.payment_info)
-        paytype = info['paytype'] if 'paytype' in info else None
-
-        for type, paytypes in DIBS.CARD_TYPES.items():
-            if paytype in paytypes:
-                return type
+        return DIBS.get_card_type(info.get('paytype'))
 
+    @staticmethod
+    def check_callback_parameters(parameters):
+        """
+        Cheap sanity check of callback parameters before anything is looked up
+        in the database. Returns the name of the first malformed parameter, or
+        None if the parameters look fine.
+        """
+        for name, pattern in CALLBACK_PARAMETER_PATTERNS.items():
+            value = parameters.get(name)
+            if value is None:
+                if name in REQUIRED_CALLBACK_PARAMETERS:
+                    return name
+            elif not pattern.match(value):
+                return name
+        # Only currencies accepted by DIBS, so unknown codes are not looked up in pycountry.
+        if parameters.get('currency') not in ALPHA_3_CODES:
+            return 'currency'
         return None
 
     @staticmethod
     def get_order_payment(order_id):
         """Get orderpayment from DIBS order id"""
         # An order code only contains alphanumeric characters.
-        match = re.search('^(?P<organizer>.+)/(?P<event>.+)/(?P<code>.+)/(?P<payment>[0-9]+)$', order_id)
+        match = re.search('^(?P<organizer>.+)/(?P<event>.+)/(?P<code>.+)/(?P<payment>[0-9]+)$', order_id or '')
         if match is None:
             return None
-        event = Event.objects.get(organizer__slug=match.group('organizer'), slug=match.group('event'))
-        return OrderPayment.objects.get(order__code=match.group('code'), order__event=event, local_id=match.group('payment'))
+        payment = transactions.find_payment(order_id)
+        if payment is not None:
+            return payment
+        try:
+            event = Event.objects.get(organizer__slug=match.group('organizer'), slug=match.group('event'))
+            return OrderPayment.objects.get(order__code=match.group('code'), order__event=event, local_id=match.group('payment'))
+        except (Event.DoesNotExist, OrderPayment.DoesNotExist):
+            return None
+
+    @staticmethod
+    def resolve_payment(order_id, payment_id=None):
+        """
+        Get the orderpayment a callback refers to.
+
+        Callback URLs carry the payment id, which lets us load the payment with
+        its order, event and organizer in a single query. The DIBS order id is
+        then only used as a cross-check. Callbacks for URLs without a payment id
+        fall back to parsing the DIBS order id.
+        """
+        if payment_id is None:
+            return DIBS.get_order_payment(order_id)
+
+        try:
+            payment = OrderPayment.objects.select_related(
+                'order', 'order__event', 'order__event__organizer'
+            ).get(pk=payment_id)
+        except (OrderPayment.DoesNotExist, ValueError):
+            return None
+
+        event = payment.order.event
+        if order_id != '/'.join([event.organizer.slug, event.slug, payment.order.code, str(payment.local_id)]):
+            return None
+        return payment
 
     def _redirect_to_dibs(self, request, payment):
-        self.set_payment_info(request, payment)
-        return build_absolute_uri(request.event, 'plugins:pretix_paymentdibs:redirect')
+        token = self.set_payment_info(request, payment)
+        url = build_absolute_uri(request.event, 'plugins:pretix_paymentdibs:redirect')
+        if token:
+            url += '?' + urlencode({'token': token})
+        return url
 
     def set_payment_info(self, request, payment):
-        request.session['payment_dibs_payment_info'] = {
+        """
+        Store the payment info for the redirect and return views.
+
+        In stateless mode, nothing is written to the session and a signed
+        token carrying the info is returned instead. The token is not
+        encrypted, so it does not contain the order secret.
+        """
+        merchant = self.merchant_for(payment) if 'merchant' in payment.info_data else self.choose_merchant()
+        if payment.info_data.get('merchant') != merchant.merchant_id:
+            payment.info_data = dict(payment.info_data, merchant=merchant.merchant_id)
+            payment.save(update_fields=['info'])
+
+        info = {
             'order_id': self.get_order_id(payment),
             'order_code': payment.order.code,
-            'order_secret': payment.order.secret,
+            'order_hash': hashlib.sha1(payment.order.secret.lower().encode()).hexdigest(),
             'payment_id': payment.pk,
             'amount': int(100 * payment.amount),
             'currency': self.currency_code,
-            'merchant_id': self.settings.get('merchant_id'),
-            'test_mode': self.settings.get('test_mode') == 'True',
-            'md5key': self._calculate_md5key(payment),
-            'decorator': self.settings.get('decorator'),
-            'capturenow': True,
+            'merchant_id': merchant.merchant_id,
+            'test_mode': self.config.test_mode,
+            'md5key': self._calculate_md5key(payment, merchant),
+            'decorator': self.config.decorator,
+            'capturenow': self.config.capture_now,
             'ordertext': None
         }
+        if self.config.stateless_checkout:
+            return signing.dumps(info, salt=PAYMENT_INFO_SALT, compress=True)
+
+        info['order_secret'] = payment.order.secret
+        request.session['payment_dibs_payment_info'] = info
 
     @staticmethod
     def get_payment_info(request):
-        return request.session['payment_dibs_payment_info']
+        token = request.GET.get('token')
+        if token:
+            try:
+                return signing.loads(token, salt=PAYMENT_INFO_SALT, max_age=PAYMENT_INFO_MAX_AGE)
+            except signing.BadSignature:
+                return None
+        return request.session.get('payment_dibs_payment_info')
 
     @staticmethod
-    def process_callback(request, log=True):
+    def get_callback_parameters(request):
         # @see https://tech.dibspayment.com/D2/Hosted/Output_parameters/Return_pages
         # @see https://tech.dibspayment.com/D2/Hosted/Output_parameters/Return_parameters
         parameters = request.POST if request.method == 'POST' else request.GET
+        return parameters.dict()
+
+    @staticmethod
+    def process_callback(request, log=True, payment_id=None):
+        return DIBS.handle_callback(request.event, DIBS.get_callback_parameters(request), log=log, payment_id=payment_id)
+
+    @staticmethod
+    def handle_callback(event, parameters, log=True, payment_id=None, verified=False):
+        """
+        Process a set of DIBS callback parameters for an event.
+
+        This is shared by the inline webhook, the return view and the
+        asynchronous callback queue (cf. tasks.process_received_callback).
+        DIBS reports the same transaction to several of these, so results are
+        cached by (orderid, transact, statuscode) and only one worker at a time
+        processes callbacks for a payment. A callback that cannot get the lock
+        within CALLBACK_LOCK_WAIT seconds raises CallbackBusy, so it can be
+        delivered again. Callbacks that fail validation are not cached, so a
+        forged callback cannot hide the genuine one.
+
+        Set `verified` for parameters that were fetched from the DIBS admin API
+        and therefore carry no authkey.
+        """
+        order_id = parameters.get('orderid')
+        result_key = cache_key('callback', order_id, parameters.get('transact'), parameters.get('statuscode'))
+        cached = cache.get(result_key)
+        # A callback that was processed without logging is processed again if a log entry is requested.
+        if cached is not None and (cached['logged'] or not log):
+            return cached['result']
+
+        deadline = time.monotonic() + CALLBACK_LOCK_WAIT
+        while True:
+            with cache_lock(cache_key('callback_lock', order_id), timeout=CALLBACK_LOCK_TIMEOUT) as acquired:
+                if acquired:
+                    cached = cache.get(result_key)
+                    if cached is None or (log and not cached['logged']):
+                        cached = {
+                            'result': DIBS._handle_callback(event, parameters, log=log, payment_id=payment_id,
+                                                            verified=verified),
+                            'logged': log,
+                        }
+                        if cached['result']:
+                            cache.set(result_key, cached, CALLBACK_RESULT_TIMEOUT)
+                    return cached['result']
+            if time.monotonic() > deadline:
+                raise CallbackBusy(order_id)
+            time.sleep(0.1)
+
+    @staticmethod
+    def _handle_callback(event, parameters, log=True, payment_id=None, verified=False):
+        from pretix.base.services.mail import SendMailException
 
         order_id = parameters.get('orderid')
-        payment = DIBS.get_order_payment(order_id)
+        with metrics.timer('pretix_dibs_callback_duration_seconds', stage='lookup'):
+            payment = DIBS.resolve_payment(order_id, payment_id)
 
-        if payment.provider != DIBS.identifier or payment.order.event != request.event:
+        if payment is None or payment.provider != DIBS.identifier or payment.order.event != event:
+            metrics.increment('pretix_dibs_callbacks_rejected_total', reason='unknown_payment')
             return False
 
-        info = json.loads(json.dumps(parameters))
+        info = DIBS.compact_callback_info(parameters)
         info['currency_code'] = info['currency']
-        info['currency'] = pycountry.currencies.get(numeric=info['currency']).alpha_3
+        info['currency'] = get_alpha_3_code(info['currency'])
+        if info['currency'] is None:
+            metrics.increment('pretix_dibs_callbacks_rejected_total', reason='malformed')
+            return False
         info['statuscode'] = int(info['statuscode'])
+        info['merchant'] = payment.info_data.get('merchant') or payment.payment_provider.config.merchant_id
         status_code = info['statuscode']
+        metrics.increment('pretix_dibs_callbacks_total', statuscode=status_code)
 
-        payment.order.log_action('pretix_paymentdibs.callback', data=info)
+        if log:
+            payment.order.log_action('pretix_paymentdibs.callback', data=DIBS.callback_log_data(info))
 
-        if status_code in {DIBS.STATUS_CODE_AUTHORIZATION_APPROVED, DIBS.STATUS_CODE_CAPTURE_COMPLETED}:
-            payment_provider = payment.payment_provider
-            if payment_provider.validate_transaction(payment, parameters):
+        payment_provider = payment.payment_provider
+        if verified:
+            valid = True
+        elif 'authkey' in parameters:
+            with metrics.timer('pretix_dibs_callback_duration_seconds', stage='validate'):
+                valid = payment_provider.validate_transaction(payment, parameters)
+        else:
+            valid = False
+        if not valid and (status_code in DIBS.CONFIRMED_STATUS_CODES or 'authkey' in parameters):
+            metrics.increment('pretix_dibs_authkey_failures_total')
+            logger.warning('Invalid authkey in DIBS callback for payment %s', payment.pk)
+            return False
+
+        if valid and log:
+            # Only verified callbacks are counted and indexed, so forged ones cannot overwrite them.
+            # Only logged ones are, so the return view does not count them twice.
+            statistics.record_callback(event, info)
+            transactions.record_payment(payment, info, info['merchant'])
+
+        if status_code in DIBS.CONFIRMED_STATUS_CODES:
+            if payment.state != OrderPayment.PAYMENT_STATE_CONFIRMED:
                 try:
-                    payment.info_data = info
-                    payment.confirm()
+                    with metrics.timer('pretix_dibs_callback_duration_seconds', stage='confirm'):
+                        if status_code in DIBS.AUTHORISED_STATUS_CODES and not payment_provider.config.capture_now:
+                            # Captured later by the batch capture task, cf. capture.py
+                            info['capture'] = DIBS.CAPTURE_PENDING
+                        payment.info_data = info
+                        payment.confirm()
                 except Quota.QuotaExceededException as e:
                     raise PaymentException(str(e))
                 except SendMailException:
                     raise PaymentException(_('There was an error sending the confirmation mail.'))
+            elif status_code in DIBS.CAPTURED_STATUS_CODES and payment.info_data.get('capture') == DIBS.CAPTURE_PENDING:
+                # Captured by the batch capture task or in the DIBS admin
+                from .capture import set_capture_state
+                set_capture_state(payment, DIBS.CAPTURE_DONE, status_code)
+
+        return True
+
+    @staticmethod
+    def compact_callback_info(info):
+        """Reduce callback parameters to the ones we store, cf. CALLBACK_FIELDS."""
+        return {k: info[k] for k in DIBS.CALLBACK_FIELDS if k in info}
+
+    @staticmethod
+    def compact_payment_info(info):
+        """Reduce stored payment info to the fields we use."""
+        return {k: info[k] for k in DIBS.CALLBACK_FIELDS + DIBS.PAYMENT_INFO_FIELDS if k in info}
+
+    @staticmethod
+    def compact_log_data(data):
+        """Reduce the data of an existing callback log entry like callback_log_data, keeping the merchant."""
+        return DIBS.callback_log_data({k: data[k] for k in DIBS.CALLBACK_FIELDS + ('merchant',) if k in data})
+
+    @staticmethod
+    def callback_log_data(info):
+        """The part of the callback info written to the order log."""
+        if compact_callback_log_enabled():
+            return {k: info[k] for k in DIBS.CALLBACK_LOG_FIELDS if k in info}
+        return info
 
     def validate_transaction(self, payment, parameters):
         # https://tech.dibspayment.com/D2/API/MD5
-        key1 = self.settings.get('md5_key1')
-        key2 = self.settings.get('md5_key2')
+        merchant = self.merchant_for(payment)
+        key1 = merchant.md5_key1
+        key2 = merchant.md5_key2
 
         transact = parameters['transact']
         currency = self.currency_code
         amount = DIBS.get_amount(payment.amount)
 
-        authkey = DIBS.md5(key2 + DIBS.md5(key1 + 'transact=' + transact + '&amount=' + amount + '&currency=' + currency))
+        return parameters['authkey'] == hashing.authkey(key1, key2, transact, amount, currency)
 
-        return parameters['authkey'] == authkey
-
-    def _calculate_md5key(self, payment):
+    def _calculate_md5key(self, payment, merchant=None):
         # https://tech.dibspayment.com/D2/Hosted/Md5_calculation
-        key1 = self.settings.get('md5_key1')
-        key2 = self.settings.get('md5_key2')
-        merchant = self.settings.get('merchant_id')
+        merchant = merchant or self.merchant_for(payment)
+        key1 = merchant.md5_key1
+        key2 = merchant.md5_key2
         orderid = self.get_order_id(payment)
         currency = self.currency_code
         amount = DIBS.get_amount(payment.amount)
 
-        parameters = 'merchant=' + merchant + '&orderid=' + orderid + '&currency=' + currency + '&amount=' + amount
-        inner_md5 = DIBS.md5(key1 + parameters)
-        md5key = DIBS.md5(key2 + inner_md5)
-
-        return md5key
+        return hashing.md5key(key1, key2, merchant.merchant_id, orderid, currency, amount)
 
     @staticmethod
     def md5(s):
         """Calculate md5 hash of a string"""
-        return hashlib.md5(s.encode('utf-8')).hexdigest()
+        return hashing.md5(s)
 
     def matching_id(self, payment: OrderPayment):
         try:
@@ -0,0 +1,172 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.timezone import now
+from django_scopes import scope
+
+from pretix.base.models import OrderPayment
+
+from .utils import RateLimiter, cache_key
+
+logger = logging.getLogger('pretix.plugins.payment_dibs')
+
+# Seconds until a payment DIBS had no answer for is queried again, doubled after every further check.
+RECONCILE_BACKOFF = 15 * 60
+RECONCILE_MAX_BACKOFF = 24 * 3600
+
+
+def _config(name, fallback):
+    return settings.CONFIG_FILE.getint('pretix_paymentdibs', name, fallback=fallback)
+
+
+def pending_payment_ids():
+    """
+    Ids of DIBS payments that are still waiting for a callback, oldest first.
+
+    Only payments whose customer was sent to DIBS are included, which is when
+    the merchant is recorded (cf. DIBS.set_payment_info). Checkouts abandoned
+    before that can not have a transaction.
+    """
+    from .payment import DIBS
+
+    return OrderPayment.objects.filter(
+        provider=DIBS.identifier,
+        state__in=(OrderPayment.PAYMENT_STATE_CREATED, OrderPayment.PAYMENT_STATE_PENDING),
+        created__lt=now() - timedelta(minutes=_config('reconcile_after_minutes', 30)),
+        created__gt=now() - timedelta(days=_config('reconcile_max_age_days', 7)),
+        info__contains='"merchant": "',
+    ).order_by('pk').values_list('pk', flat=True)
+
+
+def checked_key(payment_id):
+    return cache_key('reconcile_checked', payment_id)
+
+
+def due_payment_ids(ids):
+    """The ids whose backoff since they were last checked has passed, cf. mark_checked."""
+    checked = cache.get_many([checked_key(pk) for pk in ids])
+    return [pk for pk in ids if checked.get(checked_key(pk), (0, 0))[1] <= time.time()]
+
+
+def mark_checked(ids):
+    """Record that DIBS was queried for the payments, so they are queried less and less often."""
+    checked = cache.get_many([checked_key(pk) for pk in ids])
+    timeout = _config('reconcile_max_age_days', 7) * 24 * 3600
+    values = {}
+    for pk in ids:
+        checks = checked.get(checked_key(pk), (0, 0))[0] + 1
+        values[checked_key(pk)] = (checks, time.time() + min(RECONCILE_BACKOFF * 2 ** (checks - 1), RECONCILE_MAX_BACKOFF))
+    cache.set_many(values, timeout)
+
+
+def query_status(payment, provider, limiter):
+    """
+    Ask DIBS for the transaction of a payment. Returns callback-like parameters,
+    or None if DIBS does not know about a transaction for the payment.
+
+    Only talks to DIBS, the provider's settings must already be loaded.
+    """
+    from .client import get_client
+    from .payment import DIBS
+
+    merchant = provider.merchant_for(payment).merchant_id
+    auth = provider.get_api_authorization()
+    if not all(auth):
+        return None
+
+    orderid = provider.get_order_id(payment)
+    amount = DIBS.get_amount(payment.amount)
+    currency = provider.currency_code
+    client = get_client()
+
+    limiter.wait(merchant)
+    info = client.transaction_info({
+        'merchant': merchant,
+        'orderid': orderid,
+        'currency': currency,
+        'amount': amount,
+    }, auth)
+    if 'transact' not in info:
+        return None
+    transact = info['transact'][0]
+
+    limiter.wait(merchant)
+    status = client.payment_info({'merchant': merchant, 'transact': transact}, auth)
+    try:
+        statuscode = int(status['status'][0])
+    except (KeyError, ValueError):
+        return None
+
+    return {
+        'orderid': orderid,
+        'transact': transact,
+        'amount': amount,
+        'currency': currency,
+        'statuscode': str(statuscode),
+        'reconciled': 'true',
+    }
+
+
+def _query(payment, provider, limiter):
+    try:
+        return payment, query_status(payment, provider, limiter)
+    except Exception:
+        logger.exception('Could not query DIBS for payment %s', payment.pk)
+        return payment, None
+
+
+def reconcile_pending_payments():
+    """
+    Look up pending DIBS payments at DIBS and process what we find like a callback.
+
+    Payments are handled in chunks so memory stays bounded however many are
+    open. Within a chunk, DIBS is queried concurrently (rate limited per
+    merchant); the results are then processed sequentially. Payments that
+    are still pending are queried again after a growing backoff.
+
+    Must be called with scopes disabled.
+    """
+    from .payment import DIBS
+
+    chunk_size = _config('reconcile_chunk_size', 200)
+    limiter = RateLimiter(_config('reconcile_rate', 5))
+    ids = pending_payment_ids().iterator(chunk_size=chunk_size)
+    providers = {}
+    found = 0
+
+    with ThreadPoolExecutor(max_workers=_config('reconcile_workers', 8)) as executor:
+        while True:
+            chunk = [pk for _, pk in zip(range(chunk_size), ids)]
+            if not chunk:
+                break
+            chunk = due_payment_ids(chunk)
+            if not chunk:
+                continue
+            payments = OrderPayment.objects.filter(pk__in=chunk).select_related(
+                'order', 'order__event', 'order__event__organizer'
+            )
+            # Load providers and their settings here, so the workers only do network I/O.
+            jobs = []
+            for payment in payments:
+                if payment.order.event_id not in providers:
+                    provider = payment.payment_provider
+                    provider.config
+                    providers[payment.order.event_id] = provider
+                jobs.append((payment, providers[payment.order.event_id]))
+
+            for payment, parameters in executor.map(lambda job: _query(*job, limiter), jobs):
+                if parameters is None:
+                    continue
+                found += 1
+                event = payment.order.event
+                with scope(organizer=event.organizer):
+                    try:
+                        DIBS.handle_callback(event, parameters, payment_id=payment.pk, verified=True)
+                    except Exception:
+                        logger.exception('Could not reconcile DIBS payment %s', payment.pk)
+            mark_checked(chunk)
+    return found
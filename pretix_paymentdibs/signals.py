@@ -1,8 +1,31 @@
 import json
+import re
 
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from pretix.base.signals import register_payment_providers, logentry_display
-from django.utils.translation import gettext as _
+from django_scopes import scopes_disabled
+from pretix.base.models import Event_SettingsStore
+from pretix.base.signals import (
+    register_payment_providers, logentry_display, periodic_task, register_data_exporters,
+    register_multievent_data_exporters, register_notification_types,
+)
+from pretix.helpers.periodic import minimum_interval
+from django.template.loader import get_template
+from django.utils.translation import gettext as _, gettext_noop
+from pretix.control.signals import event_dashboard_widgets
+
+# action type: (field, message), the field's value is shown in the message
+LOG_DISPLAY = {
+    'pretix_paymentdibs.callback': ('statuscode', gettext_noop('DIBS reported a status code: {}')),
+    'pretix_paymentdibs.capture': ('capture', gettext_noop('DIBS capture state: {}')),
+    'pretix_paymentdibs.capture.failed': ('result', gettext_noop('DIBS payment could not be captured, result code: {}')),
+}
+# Log entry data is stored as JSON with sorted keys, cf. LogEntry.data
+LOG_FIELD_PATTERNS = {
+    field: re.compile(r'"{}": "?([\w-]+)'.format(field)) for field, message in LOG_DISPLAY.values()
+}
+
 
 @receiver(register_payment_providers, dispatch_uid="payment_dibs")
 def register_payment_provider(sender, **kwargs):
@@ -10,10 +33,72 @@ def register_payment_provider(sender, **kwargs):
     return DIBS
 
 
+@receiver(register_data_exporters, dispatch_uid="payment_dibs_export_transactions")
+@receiver(register_multievent_data_exporters, dispatch_uid="payment_dibs_export_transactions_multievent")
+def register_transaction_exporter(sender, **kwargs):
+    from .exporters import DIBSTransactionExporter
+    return DIBSTransactionExporter
+
+
+@receiver(register_notification_types, dispatch_uid="payment_dibs_notification_types")
+def register_notification_type(sender, **kwargs):
+    from .notifications import CaptureFailedNotificationType
+    return [CaptureFailedNotificationType(sender)]
+
+
+@receiver(event_dashboard_widgets, dispatch_uid="payment_dibs_dashboard_widget")
+def dashboard_widget(sender, lazy=False, **kwargs):
+    if not sender.settings.get('payment_dibs__enabled', as_type=bool):
+        return []
+
+    from .statistics import summary
+    return [{
+        'content': None if lazy else get_template('pretix_paymentdibs/dashboard_widget.html').render({
+            'stats': summary(sender),
+        }),
+        'lazy': 'dibs-statistics',
+        'display_size': 'small',
+        'priority': 50,
+    }]
+
+
 @receiver(signal=logentry_display, dispatch_uid="payment_dibs_logentry_display")
 def pretixcontrol_logentry_display(sender, logentry, **kwargs):
-    if logentry.action_type != 'pretix_paymentdibs.callback':
+    if logentry.action_type not in LOG_DISPLAY:
+        return
+
+    field, message = LOG_DISPLAY[logentry.action_type]
+    # Only one code is shown, so pick it from the raw data instead of parsing the whole callback.
+    match = LOG_FIELD_PATTERNS[field].search(logentry.data or '')
+    return _(message).format(match.group(1) if match else logentry.parsed_data.get(field))
+
+
+@receiver(periodic_task, dispatch_uid="payment_dibs_requeue_callbacks")
+@scopes_disabled()
+def requeue_callbacks(sender, **kwargs):
+    from .tasks import requeue_callbacks
+    requeue_callbacks()
+
+
+@receiver(periodic_task, dispatch_uid="payment_dibs_reconcile_payments")
+@minimum_interval(minutes_after_success=15)
+def reconcile_payments(sender, **kwargs):
+    from .tasks import reconcile_pending_payments
+    reconcile_pending_payments.apply_async()
+
+
+@receiver(periodic_task, dispatch_uid="payment_dibs_capture_payments")
+@minimum_interval(minutes_after_success=15)
+def capture_payments(sender, **kwargs):
+    from .tasks import capture_authorised_payments
+    capture_authorised_payments.apply_async()
+
+
+@receiver(post_save, sender=Event_SettingsStore, dispatch_uid="payment_dibs_settings_saved")
+@receiver(post_delete, sender=Event_SettingsStore, dispatch_uid="payment_dibs_settings_deleted")
+def invalidate_config(sender, instance, **kwargs):
+    if not instance.key.startswith('payment_dibs_'):
         return
 
-    data = logentry.parsed_data
-    return _('DIBS reported a status code: {}').format(data['statuscode'])
+    from .payment import config_cache_key
+    cache.delete(config_cache_key(instance.object_id))
@@ -0,0 +1,87 @@
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils.timezone import now
+
+from .models import PaymentStatistic
+
+logger = logging.getLogger('pretix.plugins.payment_dibs')
+
+
+def event_date(event, dt=None):
+    """The day a statistic is counted on, in the event's time zone."""
+    return (dt or now()).astimezone(event.timezone).date()
+
+
+def increment(event, kind, value, date=None, amount=1):
+    date = date or event_date(event)
+    counters = PaymentStatistic.objects.filter(event=event, date=date, kind=kind, value=str(value))
+    if counters.update(count=F('count') + amount):
+        return
+    try:
+        with transaction.atomic():
+            PaymentStatistic.objects.create(event=event, date=date, kind=kind, value=str(value), count=amount)
+    except IntegrityError:
+        # Created by a concurrent request in the meantime
+        counters.update(count=F('count') + amount)
+
+
+def callback_values(info):
+    """(kind, value) pairs counted for a processed callback."""
+    from .payment import DIBS
+
+    values = [(PaymentStatistic.KIND_STATUSCODE, info['statuscode'])]
+    if info.get('paytype'):
+        values.append((PaymentStatistic.KIND_PAYTYPE, info['paytype']))
+        card_type = DIBS.get_card_type(info['paytype'])
+        if card_type:
+            values.append((PaymentStatistic.KIND_CARD_TYPE, card_type))
+    return values
+
+
+def record_callback(event, info):
+    """Count a processed callback. Statistics must never break payment processing."""
+    try:
+        for kind, value in callback_values(info):
+            increment(event, kind, value)
+    except Exception:
+        logger.exception('Could not update DIBS statistics')
+
+
+def record_refund(event, result):
+    try:
+        increment(event, PaymentStatistic.KIND_REFUND_RESULT, result)
+    except Exception:
+        logger.exception('Could not update DIBS statistics')
+
+
+def summary(event, days=30):
+    """
+    Counters of the last `days` days, by kind and value, with decline and refund failure rates.
+
+    Only reads the daily counters, so it costs the same regardless of the number of orders.
+    """
+    from .payment import DIBS
+
+    counts = defaultdict(dict)
+    rows = PaymentStatistic.objects.filter(
+        event=event, date__gt=event_date(event) - timedelta(days=days)
+    ).values('kind', 'value').annotate(total=Sum('count'))
+    for row in rows:
+        counts[row['kind']][row['value']] = row['total']
+
+    statuscodes = counts[PaymentStatistic.KIND_STATUSCODE]
+    confirmed = sum(statuscodes.get(str(code), 0) for code in DIBS.CONFIRMED_STATUS_CODES)
+    declined = sum(statuscodes.get(str(code), 0) for code in DIBS.DECLINED_STATUS_CODES)
+    refunds = counts[PaymentStatistic.KIND_REFUND_RESULT]
+    refunds_failed = sum(count for result, count in refunds.items() if result != str(DIBS.REFUND_ACCEPTED))
+
+    return {
+        'days': days,
+        'counts': {kind: dict(sorted(values.items(), key=lambda v: -v[1])) for kind, values in counts.items()},
+        'decline_rate': declined / (confirmed + declined) if confirmed + declined else None,
+        'refund_failure_rate': refunds_failed / sum(refunds.values()) if refunds else None,
+    }
@@ -0,0 +1,155 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+
+from pretix.base.models import Event
+from pretix.base.payment import PaymentException
+from pretix.base.services.tasks import EventTask
+from pretix.celery_app import app
+
+from . import metrics
+from .models import ReceivedCallback
+from .utils import cache_key, cache_lock
+
+logger = logging.getLogger('pretix.plugins.payment_dibs')
+
+# Callbacks are retried this many times before they are marked as failed.
+MAX_CALLBACK_ATTEMPTS = 5
+# A claimed callback that has not been finished after this long is considered abandoned by its worker.
+CLAIM_TIMEOUT = timedelta(minutes=10)
+# Seconds a background job holds its lock, so a crashed run does not block the next ones forever.
+JOB_LOCK_TIMEOUT = 6 * 3600
+# Processed callbacks are deleted in batches of this size.
+CLEANUP_BATCH_SIZE = 1000
+
+
+def async_callbacks_enabled():
+    return settings.CONFIG_FILE.getboolean('pretix_paymentdibs', 'async_callbacks', fallback=False)
+
+
+def enqueue_callback(event, payment_id, parameters):
+    """
+    Store raw callback parameters and hand them to a worker.
+
+    The row is written before the task is sent, so a callback survives a
+    lost task message and is picked up by the periodic sweep instead.
+    """
+    received = ReceivedCallback.objects.create(event=event, payment_id=payment_id, parameters=parameters)
+    process_received_callback.apply_async(kwargs={'event': event.pk, 'callback': received.pk})
+    return received
+
+
+def queue_depth():
+    depth = ReceivedCallback.objects.filter(state=ReceivedCallback.STATE_PENDING).count()
+    metrics.gauge('pretix_dibs_callback_queue_depth', depth)
+    return depth
+
+
+def claim_callback(pk):
+    """Atomically move a pending callback to processing. Returns False if another worker got it first."""
+    return ReceivedCallback.objects.filter(
+        pk=pk, state=ReceivedCallback.STATE_PENDING
+    ).update(
+        state=ReceivedCallback.STATE_PROCESSING, claimed=now(), attempts=F('attempts') + 1
+    ) == 1
+
+
+def run_callback(event, received):
+    from .payment import DIBS, CallbackBusy
+
+    try:
+        DIBS.handle_callback(event, received.parameters, payment_id=received.payment_id)
+    except CallbackBusy:
+        # Another callback of the payment is being processed, try again later.
+        received.state = ReceivedCallback.STATE_PENDING
+    except PaymentException as e:
+        # Payment exceptions are final (quota exceeded, mail errors); retrying will not change the outcome.
+        logger.exception('Payment exception in callback')
+        received.state = ReceivedCallback.STATE_FAILED
+        received.error = str(e)
+    except Exception as e:
+        logger.exception('Error processing queued callback')
+        received.state = (
+            ReceivedCallback.STATE_FAILED
+            if received.attempts >= MAX_CALLBACK_ATTEMPTS
+            else ReceivedCallback.STATE_PENDING
+        )
+        received.error = str(e)
+    else:
+        received.state = ReceivedCallback.STATE_DONE
+        received.error = None
+    received.processed = now()
+    received.save(update_fields=['state', 'error', 'processed'])
+    return received.state
+
+
+@app.task(base=EventTask, bind=True, max_retries=MAX_CALLBACK_ATTEMPTS, default_retry_delay=30)
+def process_received_callback(self, event: Event, callback: int):
+    if not claim_callback(callback):
+        return
+    received = ReceivedCallback.objects.get(pk=callback)
+    if run_callback(event, received) == ReceivedCallback.STATE_PENDING:
+        self.retry()
+
+
+def callback_retention():
+    return timedelta(days=settings.CONFIG_FILE.getint('pretix_paymentdibs', 'callback_retention_days', fallback=7))
+
+
+def delete_processed_callbacks():
+    """Delete callbacks that were processed successfully longer ago than the retention period."""
+    old = ReceivedCallback.objects.filter(state=ReceivedCallback.STATE_DONE, processed__lt=now() - callback_retention())
+    deleted = 0
+    while True:
+        batch = list(old.values_list('pk', flat=True)[:CLEANUP_BATCH_SIZE])
+        if not batch:
+            return deleted
+        deleted += ReceivedCallback.objects.filter(pk__in=batch).delete()[0]
+
+
+def requeue_callbacks():
+    """Release abandoned claims, re-dispatch everything that is still pending and clean up."""
+    ReceivedCallback.objects.filter(
+        state=ReceivedCallback.STATE_PROCESSING, claimed__lt=now() - CLAIM_TIMEOUT
+    ).update(state=ReceivedCallback.STATE_PENDING)
+
+    pending = ReceivedCallback.objects.filter(
+        state=ReceivedCallback.STATE_PENDING, received__lt=now() - timedelta(minutes=1)
+    ).values_list('pk', 'event_id')
+    for pk, event_id in pending.iterator():
+        process_received_callback.apply_async(kwargs={'event': event_id, 'callback': pk})
+
+    delete_processed_callbacks()
+    queue_depth()
+
+
+@app.task()
+@scopes_disabled()
+def reconcile_pending_payments():
+    from .reconciliation import reconcile_pending_payments
+
+    # The periodic task only dispatches this, so overlapping runs are prevented here.
+    with cache_lock(cache_key('job', 'reconcile'), timeout=JOB_LOCK_TIMEOUT) as acquired:
+        if not acquired:
+            logger.info('DIBS reconciliation is still running')
+            return
+        found = reconcile_pending_payments()
+    logger.info('Reconciled %d pending DIBS payments', found)
+
+
+@app.task()
+@scopes_disabled()
+def capture_authorised_payments():
+    from .capture import capture_authorised_payments
+
+    # Two runs at the same time would call capture.cgi for the same payments.
+    with cache_lock(cache_key('job', 'capture'), timeout=JOB_LOCK_TIMEOUT) as acquired:
+        if not acquired:
+            logger.info('DIBS capture is still running')
+            return
+        captured = capture_authorised_payments()
+    logger.info('Captured %d authorised DIBS payments', captured)
@@ -0,0 +1,60 @@
+import logging
+
+from django.utils.timezone import now
+
+from .models import DIBSTransaction
+
+logger = logging.getLogger('pretix.plugins.payment_dibs')
+
+
+def payment_values(payment, info, merchant):
+    return {
+        'event_id': payment.order.event_id,
+        'transact': str(info['transact']),
+        'orderid': info['orderid'],
+        'merchant': merchant or '',
+        'amount': payment.amount,
+        'statuscode': int(info['statuscode']) if 'statuscode' in info else None,
+    }
+
+
+def refund_values(refund, info, merchant, result):
+    return {
+        'event_id': refund.order.event_id,
+        'payment_id': refund.payment_id,
+        'transact': str(info['transact']),
+        'orderid': info['orderid'],
+        'merchant': merchant or '',
+        'amount': refund.amount,
+        'statuscode': result,
+    }
+
+
+def record_payment(payment, info, merchant):
+    """Store the transaction of a payment, given its callback info. Must never break payment processing."""
+    try:
+        DIBSTransaction.objects.update_or_create(
+            payment=payment, kind=DIBSTransaction.KIND_PAYMENT,
+            defaults=dict(payment_values(payment, info, merchant), updated=now()),
+        )
+    except Exception:
+        logger.exception('Could not store DIBS transaction of payment %s', payment.pk)
+
+
+def record_refund(refund, info, merchant, result):
+    """Store the transaction of a refund, given the info of its payment."""
+    try:
+        DIBSTransaction.objects.update_or_create(
+            refund=refund, kind=DIBSTransaction.KIND_REFUND,
+            defaults=dict(refund_values(refund, info, merchant, result), updated=now()),
+        )
+    except Exception:
+        logger.exception('Could not store DIBS transaction of refund %s', refund.pk)
+
+
+def find_payment(orderid):
+    """The payment with a DIBS order id, if a callback for it was seen before."""
+    t = DIBSTransaction.objects.filter(
+        orderid=orderid, kind=DIBSTransaction.KIND_PAYMENT,
+    ).select_related('payment__order__event__organizer').first()
+    return t.payment if t else None
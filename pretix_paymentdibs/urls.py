@@ -1,6 +1,8 @@
 from django.urls import include, path
 
+from pretix.api.urls import event_router
 from pretix.multidomain import event_url
+from .api import DIBSStatisticsViewSet
 from .views import callback, redirect_view, ReturnView
 
 event_patterns = [
@@ -11,3 +13,5 @@ event_patterns = [
             name='return'),
     ])),
 ]
+
+event_router.register('dibs_statistics', DIBSStatisticsViewSet, basename='dibs_statistics')
@@ -0,0 +1,97 @@
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+
+DIBS_BASE_URL = 'https://payment.architrade.com'
+
+
+def get_gateway_url():
+    """Base URL of the DIBS payment window and admin API, can be pointed at a stand-in for load testing."""
+    return settings.CONFIG_FILE.get('pretix_paymentdibs', 'gateway_url', fallback=DIBS_BASE_URL).rstrip('/')
+
+
+def compact_callback_log_enabled():
+    """Whether callback log entries only keep the transaction number and status code."""
+    return settings.CONFIG_FILE.getboolean('pretix_paymentdibs', 'compact_callback_log', fallback=False)
+
+
+def cache_key(prefix, *parts):
+    """Build a short cache key that is safe for every cache backend."""
+    return 'pretix_paymentdibs_{}_{}'.format(prefix, hashlib.sha1('|'.join(str(p) for p in parts).encode()).hexdigest())
+
+
+@contextmanager
+def cache_lock(key, timeout=30):
+    """
+    Best-effort lock shared between all workers using the same cache.
+
+    Yields whether the lock was acquired. The lock expires after `timeout`
+    seconds so a crashed worker cannot block others forever.
+    """
+    token = uuid4().hex
+    acquired = cache.add(key, token, timeout)
+    try:
+        yield acquired
+    finally:
+        if acquired and cache.get(key) == token:
+            cache.delete(key)
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket allowing `rate` calls per second per key.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def wait(self, key):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                tokens, last = self._buckets.get(key, (self.burst, time.monotonic()))
+                current = time.monotonic()
+                tokens = min(self.burst, tokens + (current - last) * self.rate)
+                if tokens >= 1:
+                    self._buckets[key] = (tokens - 1, current)
+                    return
+                self._buckets[key] = (tokens, current)
+                delay = (1 - tokens) / self.rate
+            time.sleep(delay)
+
+
+class CacheTokenBucket:
+    """
+    Token bucket allowing `rate` requests per second per key with bursts of
+    up to `burst` requests, shared between workers through the cache.
+
+    Updates are not atomic, so under heavy concurrency slightly more requests
+    than configured may pass, which is fine for abuse protection.
+    """
+
+    def __init__(self, prefix, rate, burst):
+        self.prefix = prefix
+        self.rate = rate
+        self.burst = burst
+
+    def consume(self, key):
+        if not self.rate:
+            return True
+        key = cache_key(self.prefix, key)
+        current = time.time()
+        tokens, last = cache.get(key) or (self.burst, current)
+        tokens = min(self.burst, tokens + (current - last) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        cache.set(key, (tokens, current), int(self.burst / self.rate) + 1)
+        return allowed
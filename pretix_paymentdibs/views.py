@@ -1,54 +1,131 @@
 import hashlib
 import logging
+from urllib.parse import urlencode
 
+from django.conf import settings
 from django.contrib import messages
 from django.http import HttpResponse, Http404
-from django.shortcuts import redirect, render, get_object_or_404
+from django.shortcuts import redirect, get_object_or_404
+from django.template.loader import get_template
 from django.utils.decorators import method_decorator
 from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 from django.views import View
 from django.views.decorators.clickjacking import xframe_options_exempt
 from django.views.decorators.csrf import csrf_exempt
-from pretix_paymentdibs.payment import DIBS
 
 from pretix.base.models import Order, OrderPayment
 from pretix.base.payment import PaymentException
 from pretix.multidomain.urlreverse import build_absolute_uri, eventreverse
 
+from . import metrics
+from .utils import CacheTokenBucket, get_gateway_url
+
 logger = logging.getLogger('pretix.plugins.payment_dibs')
 
 
+# Placeholders used to build the per-event URL templates, cf. get_url_templates
+_PAYMENT = '987654321'
+_ORDER = 'DIBSORDERCODE'
+_HASH = 'DIBSORDERHASH'
+
+
+def get_url_templates(event):
+    """
+    Absolute callback and return URLs of an event with placeholders for the
+    payment, order code and hash. Building absolute URLs is comparatively
+    expensive, so this is done once per event and cached.
+    """
+    def build():
+        return {
+            'callback_url': build_absolute_uri(event, 'plugins:pretix_paymentdibs:webhook', kwargs={
+                'payment': _PAYMENT,
+            }),
+            'accept_url': build_absolute_uri(event, 'plugins:pretix_paymentdibs:return', kwargs={
+                'order': _ORDER,
+                'payment': _PAYMENT,
+                'hash': _HASH,
+                'action': 'success'
+            }),
+            'cancel_url': build_absolute_uri(event, 'plugins:pretix_paymentdibs:return', kwargs={
+                'order': _ORDER,
+                'payment': _PAYMENT,
+                'hash': _HASH,
+                'action': 'cancel'
+            }),
+        }
+
+    return event.cache.get_or_set('pretix_paymentdibs_url_templates', build, 3600)
+
+
 @xframe_options_exempt
 def redirect_view(request, *args, **kwargs):
+    from .payment import DIBS
+
     info = DIBS.get_payment_info(request)
-    template = 'pretix_paymentdibs/redirect.html'
+    if not info:
+        raise Http404(_('The payment information could not be found.'))
+    # Sessions written before order_hash was added only contain the secret.
+    order_hash = info.get('order_hash') or hashlib.sha1(info['order_secret'].lower().encode()).hexdigest()
+    query = ('?' + urlencode({'token': request.GET['token']})) if request.GET.get('token') else ''
+    payment_id = str(info['payment_id'])
+
     ctx = info.copy()
-    ctx.update({
-        'callback_url': build_absolute_uri(request.event, 'plugins:pretix_paymentdibs:webhook', kwargs={
-            'payment': info['payment_id'],
-        }),
-        'accept_url': build_absolute_uri(request.event, 'plugins:pretix_paymentdibs:return', kwargs={
-            'order': info['order_code'],
-            'payment': info['payment_id'],
-            'hash': hashlib.sha1(info['order_secret'].lower().encode()).hexdigest(),
-            'action': 'success'
-        }),
-        'cancel_url': build_absolute_uri(request.event, 'plugins:pretix_paymentdibs:return', kwargs={
-            'order': info['order_code'],
-            'payment': info['payment_id'],
-            'hash': hashlib.sha1(info['order_secret'].lower().encode()).hexdigest(),
-            'action': 'cancel'
-        }),
-    })
-
-    return render(request, template, ctx)
+    ctx['gateway_url'] = get_gateway_url()
+    for name, url in get_url_templates(request.event).items():
+        url = url.replace(_PAYMENT, payment_id)
+        if name != 'callback_url':
+            url = url.replace(_ORDER, info['order_code']).replace(_HASH, order_hash) + query
+        ctx[name] = url
+
+    # Rendered without a request, so none of the presale context processors run.
+    return HttpResponse(get_template('pretix_paymentdibs/redirect.html').render(ctx))
+
+
+def ip_bucket():
+    return CacheTokenBucket(
+        'callback_ip',
+        settings.CONFIG_FILE.getfloat('pretix_paymentdibs', 'callback_rate_ip', fallback=0),
+        settings.CONFIG_FILE.getint('pretix_paymentdibs', 'callback_burst_ip', fallback=50),
+    )
+
+
+def payment_bucket():
+    return CacheTokenBucket(
+        'callback_payment',
+        settings.CONFIG_FILE.getfloat('pretix_paymentdibs', 'callback_rate_payment', fallback=1),
+        settings.CONFIG_FILE.getint('pretix_paymentdibs', 'callback_burst_payment', fallback=10),
+    )
 
 
 @csrf_exempt
 def callback(request, **kwargs):
+    from .payment import DIBS, CallbackBusy
+    from .tasks import async_callbacks_enabled, enqueue_callback
+
+    parameters = DIBS.get_callback_parameters(request)
+    invalid = DIBS.check_callback_parameters(parameters)
+    if invalid:
+        metrics.increment('pretix_dibs_callbacks_rejected_total', reason='malformed')
+        logger.info('Rejected DIBS callback with malformed parameter %s', invalid)
+        return HttpResponse(status=400)
+
+    if not ip_bucket().consume(request.META.get('REMOTE_ADDR')):
+        metrics.increment('pretix_dibs_callbacks_rejected_total', reason='rate_ip')
+        return HttpResponse(status=429)
+    if not payment_bucket().consume(parameters['orderid']):
+        metrics.increment('pretix_dibs_callbacks_rejected_total', reason='rate_payment')
+        return HttpResponse(status=429)
+
+    if async_callbacks_enabled():
+        enqueue_callback(request.event, kwargs.get('payment'), parameters)
+        return HttpResponse(status=200)
+
     try:
-        DIBS.process_callback(request)
+        DIBS.process_callback(request, payment_id=kwargs.get('payment'))
+    except CallbackBusy:
+        # DIBS delivers the callback again if it does not get a 200
+        return HttpResponse(status=503)
     except PaymentException as e:
         logger.exception('Payment exception in callback')
 
@@ -88,20 +165,34 @@ class ReturnView(DIBSOrderView, View):
 
 
     def post(self, request, *args, **kwargs):
-        if kwargs.get('action') == 'success':
+        from .payment import DIBS, CallbackBusy
+
+        if kwargs.get('action') == 'success' and not DIBS.check_callback_parameters(DIBS.get_callback_parameters(request)):
             try:
-                DIBS.process_callback(request, log=False)
+                DIBS.process_callback(request, log=False, payment_id=self.kwargs['payment'])
+            except CallbackBusy:
+                # Being processed by the webhook
+                pass
             except PaymentException as e:
                 messages.error(request, str(e))
-        else:
+        elif kwargs.get('action') != 'success':
             self.payment.fail(info={'action': 'cancel'})
             pass
         return self._redirect_to_order()
 
     def _redirect_to_order(self):
+        from .payment import DIBS
+
         self.order.refresh_from_db()
         info = DIBS.get_payment_info(self.request)
-        if info.get('order_secret') != self.order.secret:
+        if not info:
+            valid = False
+        elif 'order_secret' in info:
+            valid = info['order_secret'] == self.order.secret
+        else:
+            # Signed token, the order itself has already been verified by the hash in the URL.
+            valid = info['order_code'] == self.order.code and info['payment_id'] == self.payment.pk
+        if not valid:
             messages.error(self.request, _('Sorry, there was an error in the payment process. Please check the link '
                                            'in your emails to continue.'))
             return redirect(eventreverse(self.request.event, 'presale:event.index'))
@@ -0,0 +1,115 @@
+import json
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+from django.core.cache import cache
+from django.utils.timezone import now
+from django_scopes import scope
+
+from pretix.base.models import Event, Order, Organizer
+
+from pretix_paymentdibs import hashing
+from pretix_paymentdibs.client import DIBSClient, set_client
+
+MD5_KEY1 = 'a' * 32
+MD5_KEY2 = 'b' * 32
+
+
+@pytest.fixture(autouse=True)
+def locmem_cache(settings):
+    # Locks, counters and the circuit breaker need a cache that actually stores things.
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    cache.clear()
+    yield
+    cache.clear()
+    set_client(None)
+
+
+@pytest.fixture
+def event():
+    o = Organizer.objects.create(name='Dummy', slug='dummy')
+    with scope(organizer=o):
+        event = Event.objects.create(
+            organizer=o, name='Dummy', slug='dummy', currency='DKK', date_from=now(), plugins='pretix_paymentdibs',
+            live=True,
+        )
+        event.settings.set('payment_dibs_merchant_id', '12345678')
+        event.settings.set('payment_dibs_md5_key1', MD5_KEY1)
+        event.settings.set('payment_dibs_md5_key2', MD5_KEY2)
+        event.settings.set('payment_dibs_api_user', 'user')
+        event.settings.set('payment_dibs_api_password', 'password')
+        yield event
+
+
+@pytest.fixture
+def order(event):
+    return Order.objects.create(
+        code='FOOBAR', event=event, email='dummy@example.org', status=Order.STATUS_PAID,
+        datetime=now(), expires=now() + timedelta(days=10), total=Decimal('100.00'),
+    )
+
+
+@pytest.fixture
+def payment(order):
+    return order.payments.create(
+        provider='dibs', amount=order.total, state='confirmed', payment_date=now(),
+        info=json.dumps({
+            'orderid': 'dummy/dummy/FOOBAR/1', 'transact': '1234567', 'statuscode': 2, 'currency': 'DKK',
+            'merchant': '12345678',
+        }),
+    )
+
+
+@pytest.fixture
+def pending_payment(order):
+    """A payment whose customer was sent to DIBS and that is waiting for the callback."""
+    return order.payments.create(
+        provider='dibs', amount=order.total, state='created', info=json.dumps({'merchant': '12345678'}),
+    )
+
+
+def callback_parameters(payment, **overrides):
+    """Parameters of a genuine DIBS callback for a payment."""
+    parameters = {
+        'orderid': 'dummy/dummy/{}/{}'.format(payment.order.code, payment.local_id),
+        'transact': '1234567',
+        'amount': str(int(payment.amount * 100)),
+        'currency': '208',
+        'statuscode': '2',
+        'paytype': 'VISA',
+    }
+    parameters.update(overrides)
+    parameters.setdefault('authkey', hashing.authkey(MD5_KEY1, MD5_KEY2, parameters['transact'],
+                                                     parameters['amount'], parameters['currency']))
+    return parameters
+
+
+class FakeTransport:
+    """Records the requests and answers them from a list of response bodies or exceptions."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def __call__(self, merchant, url, data, auth, timeout):
+        self.calls.append((merchant, url, dict(data)))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+@pytest.fixture
+def fake_transport():
+    return FakeTransport
+
+
+@pytest.fixture
+def transport():
+    """Install a client talking to a FakeTransport answering with the given responses."""
+    def install(*responses):
+        transport = FakeTransport(*responses)
+        set_client(DIBSClient(base_url='https://dibs.test', backoff=0, transport=transport))
+        return transport
+    return install
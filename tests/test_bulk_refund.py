@@ -0,0 +1,57 @@
+import json
+from decimal import Decimal
+
+import pytest
+import requests
+from django.core.management import call_command
+
+from pretix.base.models import OrderRefund
+
+# The refunds are made in worker threads, which do not see the data of a test transaction.
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+def run(checkpoint):
+    call_command('dibs_bulk_refund', event='dummy/dummy', checkpoint=str(checkpoint), rate=1000, workers=1)
+    with open(checkpoint) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_refunds_remaining_amount(payment, transport, tmp_path):
+    t = transport('status=ACCEPTED&result=0')
+    payment.refunds.create(order=payment.order, source=OrderRefund.REFUND_SOURCE_ADMIN, provider='dibs',
+                           state=OrderRefund.REFUND_STATE_DONE, amount=Decimal('30.00'))
+    entries = run(tmp_path / 'checkpoint')
+    assert entries == [{'payment': payment.pk, 'outcome': 'accepted', 'result': 0}]
+    assert t.calls[0][2]['amount'] == '7000'
+
+
+def test_refund_left_created_is_not_counted(payment, transport, tmp_path):
+    t = transport('status=ACCEPTED&result=0')
+    # Left behind by an interrupted run
+    payment.refunds.create(order=payment.order, source=OrderRefund.REFUND_SOURCE_ADMIN, provider='dibs',
+                           state=OrderRefund.REFUND_STATE_CREATED, amount=Decimal('100.00'))
+    assert run(tmp_path / 'checkpoint')[0]['outcome'] == 'accepted'
+    assert t.calls[0][2]['amount'] == '10000'
+
+
+def test_unexpected_error_fails_refund(payment, transport, tmp_path):
+    t = transport()
+    info = payment.info_data
+    del info['transact']
+    payment.info_data = info
+    payment.save()
+    entries = run(tmp_path / 'checkpoint')
+    assert entries == [{'payment': payment.pk, 'outcome': 'failed', 'result': None}]
+    assert t.calls == []
+    assert payment.refunds.get().state == OrderRefund.REFUND_STATE_FAILED
+
+
+def test_communication_error_is_retryable(payment, transport, tmp_path):
+    transport(requests.ReadTimeout(), 'status=ACCEPTED&result=0')
+    checkpoint = tmp_path / 'checkpoint'
+    assert run(checkpoint)[0]['outcome'] == 'retryable'
+    assert payment.refunds.get().state == OrderRefund.REFUND_STATE_FAILED
+    # Resuming refunds the payment, as the failed refund does not count
+    assert run(checkpoint)[1]['outcome'] == 'accepted'
+    assert payment.refunds.filter(state=OrderRefund.REFUND_STATE_DONE).count() == 1
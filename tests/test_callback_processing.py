@@ -0,0 +1,119 @@
+import hashlib
+from urllib.parse import urlencode
+
+import pytest
+
+from pretix.base.models import OrderPayment
+
+from pretix_paymentdibs import payment as payment_module
+from pretix_paymentdibs.models import DIBSTransaction, PaymentStatistic
+from pretix_paymentdibs.payment import DIBS
+from pretix_paymentdibs.utils import cache_key, cache_lock
+
+from .conftest import callback_parameters
+
+
+def webhook(client, payment, parameters):
+    return client.post('/dummy/dummy/pretix_paymentdibs/webhook/{}/'.format(payment.pk), parameters)
+
+
+def return_view(client, payment, parameters):
+    order = payment.order
+    return client.get('/dummy/dummy/pretix_paymentdibs/return/{}/{}/{}/success?{}'.format(
+        order.code, hashlib.sha1(order.secret.lower().encode()).hexdigest(), payment.pk, urlencode(parameters)
+    ))
+
+
+def count_log(order, action_type):
+    return order.all_logentries().filter(action_type=action_type).count()
+
+
+@pytest.mark.django_db
+def test_duplicate_deliveries_are_processed_once(client, pending_payment):
+    parameters = callback_parameters(pending_payment)
+    assert webhook(client, pending_payment, parameters).status_code == 200
+    assert webhook(client, pending_payment, parameters).status_code == 200
+    assert return_view(client, pending_payment, parameters).status_code == 302
+
+    pending_payment.refresh_from_db()
+    assert pending_payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+    assert count_log(pending_payment.order, 'pretix.event.order.payment.confirmed') == 1
+    assert count_log(pending_payment.order, 'pretix_paymentdibs.callback') == 1
+    assert PaymentStatistic.objects.get(kind=PaymentStatistic.KIND_STATUSCODE, value='2').count == 1
+
+
+@pytest.mark.django_db
+def test_webhook_after_return_view_is_logged(client, pending_payment):
+    parameters = callback_parameters(pending_payment)
+    return_view(client, pending_payment, parameters)
+    pending_payment.refresh_from_db()
+    assert pending_payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+    assert count_log(pending_payment.order, 'pretix_paymentdibs.callback') == 0
+
+    webhook(client, pending_payment, parameters)
+    assert count_log(pending_payment.order, 'pretix.event.order.payment.confirmed') == 1
+    assert count_log(pending_payment.order, 'pretix_paymentdibs.callback') == 1
+
+
+@pytest.mark.django_db
+def test_forged_authkey_is_not_cached_or_indexed(client, pending_payment):
+    forged = callback_parameters(pending_payment, authkey='0' * 32)
+    assert webhook(client, pending_payment, forged).status_code == 200
+    pending_payment.refresh_from_db()
+    assert pending_payment.state == OrderPayment.PAYMENT_STATE_CREATED
+    assert not DIBSTransaction.objects.exists()
+    assert not PaymentStatistic.objects.exists()
+
+    # The genuine callback for the same transaction still goes through.
+    webhook(client, pending_payment, callback_parameters(pending_payment))
+    pending_payment.refresh_from_db()
+    assert pending_payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+    assert DIBSTransaction.objects.get().payment == pending_payment
+
+
+@pytest.mark.django_db
+def test_callback_without_authkey_does_not_confirm(pending_payment):
+    parameters = callback_parameters(pending_payment)
+    del parameters['authkey']
+    assert not DIBS.handle_callback(pending_payment.order.event, parameters, payment_id=pending_payment.pk)
+    pending_payment.refresh_from_db()
+    assert pending_payment.state == OrderPayment.PAYMENT_STATE_CREATED
+
+
+@pytest.mark.django_db
+def test_orderid_must_match_payment_of_url(client, order, pending_payment):
+    other = order.payments.create(provider='dibs', amount=order.total, state='created')
+    # Signed for the other payment, but posted to the webhook of this one.
+    webhook(client, pending_payment, callback_parameters(other))
+    for p in (pending_payment, other):
+        p.refresh_from_db()
+        assert p.state == OrderPayment.PAYMENT_STATE_CREATED
+    assert count_log(order, 'pretix_paymentdibs.callback') == 0
+
+
+@pytest.mark.django_db
+def test_callback_without_payment_id_is_resolved_by_orderid(pending_payment):
+    assert DIBS.handle_callback(pending_payment.order.event, callback_parameters(pending_payment))
+    pending_payment.refresh_from_db()
+    assert pending_payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+
+
+@pytest.mark.django_db
+def test_busy_payment_is_redelivered(client, pending_payment, monkeypatch):
+    monkeypatch.setattr(payment_module, 'CALLBACK_LOCK_WAIT', 0)
+    parameters = callback_parameters(pending_payment)
+    with cache_lock(cache_key('callback_lock', parameters['orderid'])):
+        assert webhook(client, pending_payment, parameters).status_code == 503
+    pending_payment.refresh_from_db()
+    assert pending_payment.state == OrderPayment.PAYMENT_STATE_CREATED
+
+    assert webhook(client, pending_payment, parameters).status_code == 200
+    pending_payment.refresh_from_db()
+    assert pending_payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+
+
+@pytest.mark.django_db
+def test_malformed_callback_is_rejected(client, pending_payment):
+    assert webhook(client, pending_payment, callback_parameters(pending_payment, currency='000')).status_code == 400
+    pending_payment.refresh_from_db()
+    assert pending_payment.state == OrderPayment.PAYMENT_STATE_CREATED
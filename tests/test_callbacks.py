@@ -0,0 +1,45 @@
+import pytest
+
+from pretix_paymentdibs.payment import DIBS
+
+VALID = {
+    'orderid': 'dummy/dummy/FOOBAR/1',
+    'transact': '1234567',
+    'statuscode': '2',
+    'currency': '208',
+    'amount': '10000',
+    'authkey': '0123456789abcdef0123456789abcdef',
+}
+
+
+def test_valid_parameters():
+    assert DIBS.check_callback_parameters(VALID) is None
+
+
+def test_optional_parameters_may_be_missing():
+    params = dict(VALID)
+    del params['amount']
+    del params['authkey']
+    assert DIBS.check_callback_parameters(params) is None
+
+
+@pytest.mark.parametrize('name', ['orderid', 'transact', 'statuscode', 'currency'])
+def test_required_parameter_missing(name):
+    params = dict(VALID)
+    del params[name]
+    assert DIBS.check_callback_parameters(params) == name
+
+
+@pytest.mark.parametrize('name,value', [
+    ('orderid', 'dummy/FOOBAR/1'),
+    ('orderid', 'dummy/dummy/foobar/1'),
+    ('transact', '12ab'),
+    ('statuscode', '1234'),
+    ('currency', 'DKK'),
+    ('currency', '000'),
+    ('amount', '100.00'),
+    ('authkey', '0123456789ABCDEF0123456789ABCDEF'),
+    ('authkey', 'abc'),
+])
+def test_malformed_parameter(name, value):
+    assert DIBS.check_callback_parameters(dict(VALID, **{name: value})) == name
@@ -0,0 +1,109 @@
+import json
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+
+from pretix.base.models import Order, OrderRefund
+
+from pretix_paymentdibs.capture import apply_capture_result, capture_authorised_payments
+from pretix_paymentdibs.payment import DIBS
+
+
+@pytest.fixture
+def authorised(payment):
+    info = payment.info_data
+    info['capture'] = DIBS.CAPTURE_PENDING
+    payment.info = json.dumps(info)
+    payment.payment_date = now() - timedelta(hours=2)
+    payment.save()
+    return payment
+
+
+def run():
+    with scopes_disabled():
+        return capture_authorised_payments()
+
+
+def capture_state(payment):
+    payment.refresh_from_db()
+    return payment.info_data['capture']
+
+
+@pytest.mark.django_db
+def test_accepted_capture_is_done(authorised):
+    apply_capture_result(authorised, {'status': ['ACCEPTED'], 'result': ['0']})
+    assert capture_state(authorised) == DIBS.CAPTURE_DONE
+    assert authorised.order.all_logentries().filter(action_type='pretix_paymentdibs.capture').exists()
+
+
+@pytest.mark.django_db
+def test_transient_capture_result_stays_pending(authorised):
+    apply_capture_result(authorised, {'status': ['DECLINED'], 'result': ['1']})
+    assert capture_state(authorised) == DIBS.CAPTURE_PENDING
+
+
+@pytest.mark.django_db
+def test_declined_capture_is_failed_and_logged(authorised):
+    apply_capture_result(authorised, {'status': ['DECLINED'], 'result': ['7']})
+    assert capture_state(authorised) == DIBS.CAPTURE_FAILED
+    entry = authorised.order.all_logentries().get(action_type='pretix_paymentdibs.capture.failed')
+    assert entry.parsed_data['result'] == 7
+
+
+@pytest.mark.django_db
+def test_capture_state_is_only_set_once(authorised):
+    apply_capture_result(authorised, {'result': ['0']})
+    apply_capture_result(authorised, {'result': ['7']})
+    assert capture_state(authorised) == DIBS.CAPTURE_DONE
+
+
+@pytest.mark.django_db
+def test_authorised_payment_is_captured(authorised, transport):
+    t = transport('status=ACCEPTED&result=0')
+    assert run() == 1
+    assert capture_state(authorised) == DIBS.CAPTURE_DONE
+    merchant, url, data = t.calls[0]
+    assert url == 'https://dibs.test/cgi-bin/capture.cgi'
+    assert data['transact'] == '1234567'
+    assert data['amount'] == '10000'
+
+
+@pytest.mark.django_db
+def test_recent_authorisation_is_not_captured_yet(authorised, transport):
+    t = transport()
+    authorised.payment_date = now()
+    authorised.save()
+    assert run() == 0
+    assert t.calls == []
+
+
+@pytest.mark.django_db
+def test_canceled_order_is_skipped(authorised, transport):
+    t = transport()
+    authorised.order.status = Order.STATUS_CANCELED
+    authorised.order.save()
+    assert run() == 0
+    assert t.calls == []
+    assert capture_state(authorised) == DIBS.CAPTURE_SKIPPED
+
+
+@pytest.mark.django_db
+def test_refunded_amount_is_not_captured(authorised, transport):
+    t = transport('status=ACCEPTED&result=0')
+    authorised.refunds.create(order=authorised.order, source=OrderRefund.REFUND_SOURCE_ADMIN, provider='dibs',
+                              state=OrderRefund.REFUND_STATE_DONE, amount=Decimal('40.00'))
+    run()
+    assert t.calls[0][2]['amount'] == '6000'
+
+
+@pytest.mark.django_db
+def test_fully_refunded_payment_is_skipped(authorised, transport):
+    t = transport()
+    authorised.refunds.create(order=authorised.order, source=OrderRefund.REFUND_SOURCE_ADMIN, provider='dibs',
+                              state=OrderRefund.REFUND_STATE_DONE, amount=Decimal('100.00'))
+    run()
+    assert t.calls == []
+    assert capture_state(authorised) == DIBS.CAPTURE_SKIPPED
@@ -0,0 +1,61 @@
+import hashlib
+
+import pytest
+from django.core import signing
+from django.test import RequestFactory
+
+from pretix_paymentdibs.payment import DIBS, PAYMENT_INFO_SALT
+
+
+@pytest.fixture
+def stateless(event):
+    event.settings.set('payment_dibs_stateless_checkout', True)
+    return DIBS(event)
+
+
+def return_url(payment, token):
+    order = payment.order
+    return '/dummy/dummy/pretix_paymentdibs/return/{}/{}/{}/success?token={}'.format(
+        order.code, hashlib.sha1(order.secret.lower().encode()).hexdigest(), payment.pk, token
+    )
+
+
+@pytest.mark.django_db
+def test_token_round_trip(stateless, pending_payment):
+    token = stateless.set_payment_info(None, pending_payment)
+    info = DIBS.get_payment_info(RequestFactory().get('/', {'token': token}))
+    assert info['payment_id'] == pending_payment.pk
+    assert info['order_code'] == 'FOOBAR'
+    assert info['merchant_id'] == '12345678'
+    assert info['md5key'] == stateless._calculate_md5key(pending_payment)
+    assert 'order_secret' not in info
+
+
+@pytest.mark.django_db
+def test_tampered_token_is_rejected(stateless, pending_payment):
+    info = signing.loads(stateless.set_payment_info(None, pending_payment), salt=PAYMENT_INFO_SALT)
+    token = signing.dumps(dict(info, amount=1), salt='other', compress=True)
+    assert DIBS.get_payment_info(RequestFactory().get('/', {'token': token})) is None
+
+
+@pytest.mark.django_db
+def test_session_checkout_returns_no_token(event, pending_payment):
+    request = RequestFactory().get('/')
+    request.session = {}
+    assert DIBS(event).set_payment_info(request, pending_payment) is None
+    assert request.session['payment_dibs_payment_info']['order_secret'] == pending_payment.order.secret
+
+
+@pytest.mark.django_db
+def test_return_with_token_redirects_to_order(client, stateless, pending_payment):
+    response = client.get(return_url(pending_payment, stateless.set_payment_info(None, pending_payment)))
+    assert response.status_code == 302
+    assert '/order/FOOBAR/{}/'.format(pending_payment.order.secret) in response['Location']
+
+
+@pytest.mark.django_db
+def test_return_with_token_of_other_payment_is_rejected(client, stateless, order, pending_payment):
+    other = order.payments.create(provider='dibs', amount=order.total, state='created')
+    response = client.get(return_url(pending_payment, stateless.set_payment_info(None, other)))
+    assert response.status_code == 302
+    assert 'FOOBAR' not in response['Location']
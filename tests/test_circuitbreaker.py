@@ -0,0 +1,120 @@
+import pytest
+
+from pretix_paymentdibs import circuitbreaker
+from pretix_paymentdibs.circuitbreaker import (
+    STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN, CircuitBreaker, CircuitOpenError,
+)
+from pretix_paymentdibs.client import DIBSClient
+
+AUTH = ('user', 'password')
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(circuitbreaker.time, 'time', clock)
+    return clock
+
+
+def fail():
+    raise IOError()
+
+
+def trip(breaker):
+    for i in range(breaker.min_calls):
+        with pytest.raises(IOError):
+            breaker.call(fail)
+
+
+def test_closed_until_min_calls(clock):
+    breaker = CircuitBreaker('test', min_calls=3)
+    for i in range(2):
+        with pytest.raises(IOError):
+            breaker.call(fail)
+    assert breaker.state == STATE_CLOSED
+    assert breaker.call(lambda: 'ok') == 'ok'
+
+
+def test_stays_closed_below_error_ratio(clock):
+    breaker = CircuitBreaker('test', min_calls=4, error_ratio=0.5)
+    breaker.call(lambda: 'ok')
+    breaker.call(lambda: 'ok')
+    breaker.call(lambda: 'ok')
+    with pytest.raises(IOError):
+        breaker.call(fail)
+    assert breaker.state == STATE_CLOSED
+
+
+def test_opens_and_rejects_calls(clock):
+    breaker = CircuitBreaker('test', min_calls=3)
+    trip(breaker)
+    assert breaker.state == STATE_OPEN
+    called = []
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: called.append(True))
+    assert not called
+
+
+def test_failure_result_counts(clock):
+    breaker = CircuitBreaker('test', min_calls=2)
+    breaker.call(lambda: 'bad', is_failure=lambda r: r == 'bad')
+    breaker.call(lambda: 'bad', is_failure=lambda r: r == 'bad')
+    assert breaker.state == STATE_OPEN
+
+
+def test_half_open_lets_one_probe_through(clock):
+    breaker = CircuitBreaker('test', min_calls=3, open_for=30)
+    trip(breaker)
+    clock.now += 31
+    assert breaker.state == STATE_HALF_OPEN
+    assert breaker.before_call() is True
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_successful_probe_closes(clock):
+    breaker = CircuitBreaker('test', min_calls=3, open_for=30)
+    trip(breaker)
+    clock.now += 31
+    assert breaker.call(lambda: 'ok') == 'ok'
+    assert breaker.state == STATE_CLOSED
+
+
+def test_failed_probe_opens_again(clock):
+    breaker = CircuitBreaker('test', min_calls=3, open_for=30)
+    trip(breaker)
+    clock.now += 31
+    with pytest.raises(IOError):
+        breaker.call(fail)
+    assert breaker.state == STATE_OPEN
+
+
+def test_stats(clock):
+    breaker = CircuitBreaker('test', min_calls=10)
+    breaker.call(lambda: 'ok')
+    with pytest.raises(IOError):
+        breaker.call(fail)
+    stats = breaker.stats()
+    assert stats['state'] == STATE_CLOSED
+    assert stats['calls'] == 2
+    assert stats['errors'] == 1
+    assert stats['error_ratio'] == 0.5
+
+
+def test_client_failures_open_the_circuit(fake_transport):
+    transport = fake_transport(*['status=DECLINED&result=1'] * 2)
+    client = DIBSClient(base_url='https://dibs.test', max_attempts=1, backoff=0, transport=transport,
+                        breaker=CircuitBreaker('test', min_calls=2))
+    client.refund({'merchant': '12345678'}, AUTH)
+    client.refund({'merchant': '12345678'}, AUTH)
+    with pytest.raises(CircuitOpenError):
+        client.refund({'merchant': '12345678'}, AUTH)
+    assert len(transport.calls) == 2
@@ -0,0 +1,66 @@
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+
+from pretix_paymentdibs.client import DIBSClient
+
+AUTH = ('user', 'password')
+DATA = {'merchant': '12345678', 'transact': '1234567', 'amount': '10000'}
+
+
+def client(transport, **kwargs):
+    return DIBSClient(base_url='https://dibs.test', backoff=0, transport=transport, **kwargs)
+
+
+def test_reply_is_parsed(fake_transport):
+    transport = fake_transport('status=ACCEPTED&result=0')
+    reply = client(transport).refund(DATA, AUTH)
+    assert reply == {'status': ['ACCEPTED'], 'result': ['0']}
+    assert transport.calls == [('12345678', 'https://dibs.test/cgi-adm/refund.cgi', DATA)]
+
+
+def test_transient_result_is_retried(fake_transport):
+    transport = fake_transport('status=DECLINED&result=2', 'status=ACCEPTED&result=0')
+    assert client(transport).refund(DATA, AUTH)['result'] == ['0']
+    assert len(transport.calls) == 2
+
+
+def test_transient_result_is_returned_after_max_attempts(fake_transport):
+    transport = fake_transport(*['status=DECLINED&result=11'] * 3)
+    assert client(transport, max_attempts=3).refund(DATA, AUTH)['result'] == ['11']
+    assert len(transport.calls) == 3
+
+
+def test_final_result_is_not_retried(fake_transport):
+    transport = fake_transport('status=DECLINED&result=7')
+    assert client(transport).refund(DATA, AUTH)['result'] == ['7']
+    assert len(transport.calls) == 1
+
+
+@pytest.mark.parametrize('error', [
+    requests.ConnectTimeout(),
+    requests.ConnectionError(MaxRetryError(None, '/', NewConnectionError(None, 'refused'))),
+])
+def test_unsent_request_is_retried(fake_transport, error):
+    transport = fake_transport(error, 'status=ACCEPTED&result=0')
+    assert client(transport).refund(DATA, AUTH)['result'] == ['0']
+    assert len(transport.calls) == 2
+
+
+@pytest.mark.parametrize('error', [
+    requests.ConnectionError(ProtocolError('Connection aborted.', ConnectionResetError())),
+    requests.ReadTimeout(),
+])
+def test_possibly_sent_request_is_not_retried(fake_transport, error):
+    transport = fake_transport(error, 'status=ACCEPTED&result=0')
+    with pytest.raises(type(error)):
+        client(transport).refund(DATA, AUTH)
+    assert len(transport.calls) == 1
+
+
+def test_unsent_request_fails_after_max_attempts(fake_transport):
+    transport = fake_transport(*[requests.ConnectTimeout()] * 2)
+    with pytest.raises(requests.ConnectTimeout):
+        client(transport, max_attempts=2).refund(DATA, AUTH)
+    assert len(transport.calls) == 2
+
@@ -0,0 +1,23 @@
+import pytest
+
+from pretix_paymentdibs.currencies import NUMERIC_CODES, get_alpha_3_code, get_numeric_code
+
+
+@pytest.mark.parametrize('alpha_3,numeric', sorted(NUMERIC_CODES.items()))
+def test_round_trip(alpha_3, numeric):
+    assert get_numeric_code(alpha_3) == numeric
+    assert get_alpha_3_code(numeric) == alpha_3
+
+
+def test_numeric_codes_are_unique():
+    assert len(set(NUMERIC_CODES.values())) == len(NUMERIC_CODES)
+
+
+def test_numeric_code_is_zero_filled():
+    assert get_alpha_3_code(36) == 'AUD'
+    assert get_alpha_3_code('36') == 'AUD'
+    assert get_alpha_3_code(208) == 'DKK'
+
+
+def test_unknown_numeric_code():
+    assert get_alpha_3_code('000') is None
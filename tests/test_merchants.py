@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+from pretix_paymentdibs.payment import DIBS, Merchant, parse_merchants
+
+from .conftest import MD5_KEY1, MD5_KEY2
+
+KEY3 = 'c' * 32
+KEY4 = 'd' * 32
+
+
+def test_parse_merchants():
+    value = '\n'.join([
+        '87654321;{};{}'.format(KEY3, KEY4),
+        '',
+        ' 11111111 ; {} ; {} ; 3 ; eur '.format(KEY3, KEY4),
+        '22222222;{};{};;SEK'.format(KEY3, KEY4),
+    ])
+    assert parse_merchants(value) == [
+        Merchant('87654321', KEY3, KEY4),
+        Merchant('11111111', KEY3, KEY4, 3, 'EUR'),
+        Merchant('22222222', KEY3, KEY4, 1, 'SEK'),
+    ]
+    assert parse_merchants(None) == []
+
+
+@pytest.mark.parametrize('line', [
+    '87654321;{}'.format(KEY3),
+    ';{};{}'.format(KEY3, KEY4),
+    '87654321;short;{}'.format(KEY4),
+    '87654321;{};{};heavy'.format(KEY3, KEY4),
+    '87654321;{};{};1;EUR;extra'.format(KEY3, KEY4),
+])
+def test_parse_merchants_rejects_invalid_lines(line):
+    with pytest.raises(ValueError):
+        parse_merchants(line)
+
+
+def configure(event, routing, *lines):
+    event.settings.set('payment_dibs_additional_merchants', '\n'.join(lines))
+    event.settings.set('payment_dibs_merchant_routing', routing)
+    return DIBS(event)
+
+
+@pytest.mark.django_db
+def test_round_robin(event):
+    provider = configure(event, 'round_robin', '87654321;{};{}'.format(KEY3, KEY4))
+    chosen = [provider.choose_merchant().merchant_id for i in range(4)]
+    assert sorted(chosen[:2]) == ['12345678', '87654321']
+    assert chosen[2:] == chosen[:2]
+
+
+@pytest.mark.django_db
+def test_weighted_never_picks_weight_zero(event):
+    provider = configure(event, 'weighted', '87654321;{};{};0'.format(KEY3, KEY4))
+    assert {provider.choose_merchant().merchant_id for i in range(20)} == {'12345678'}
+
+
+@pytest.mark.django_db
+def test_currency_routing(event):
+    provider = configure(event, 'currency', '87654321;{};{};1;EUR'.format(KEY3, KEY4),
+                         '11111111;{};{};1;DKK'.format(KEY3, KEY4))
+    assert {provider.choose_merchant().merchant_id for i in range(5)} == {'11111111'}
+
+
+@pytest.mark.django_db
+def test_currency_routing_falls_back_to_merchants_without_currency(event):
+    provider = configure(event, 'currency', '87654321;{};{};1;EUR'.format(KEY3, KEY4))
+    assert {provider.choose_merchant().merchant_id for i in range(5)} == {'12345678'}
+
+
+@pytest.mark.django_db
+def test_merchant_for(event, payment):
+    provider = configure(event, 'round_robin', '87654321;{};{}'.format(KEY3, KEY4))
+    payment.info = json.dumps(dict(payment.info_data, merchant='87654321'))
+    assert provider.merchant_for(payment) == Merchant('87654321', KEY3, KEY4)
+    payment.info = json.dumps(dict(payment.info_data, merchant='99999999'))
+    assert provider.merchant_for(payment) == Merchant('12345678', MD5_KEY1, MD5_KEY2)
@@ -0,0 +1,93 @@
+from datetime import timedelta
+
+import pytest
+from django.utils.timezone import now
+
+from pretix.base.models import OrderPayment
+
+from pretix_paymentdibs import tasks
+from pretix_paymentdibs.models import ReceivedCallback
+from pretix_paymentdibs.payment import DIBS, CallbackBusy
+from pretix_paymentdibs.tasks import MAX_CALLBACK_ATTEMPTS, claim_callback, run_callback
+
+from .conftest import callback_parameters
+
+
+@pytest.fixture
+def received(event, pending_payment):
+    return ReceivedCallback.objects.create(event=event, payment_id=pending_payment.pk,
+                                           parameters=callback_parameters(pending_payment))
+
+
+def fail_with(monkeypatch, exc):
+    def handle_callback(*args, **kwargs):
+        raise exc
+    monkeypatch.setattr(DIBS, 'handle_callback', staticmethod(handle_callback))
+
+
+@pytest.mark.django_db
+def test_callback_is_claimed_once(received):
+    assert claim_callback(received.pk)
+    assert not claim_callback(received.pk)
+    received.refresh_from_db()
+    assert received.state == ReceivedCallback.STATE_PROCESSING
+    assert received.attempts == 1
+
+
+@pytest.mark.django_db
+def test_processed_callback_is_done(event, received, pending_payment):
+    claim_callback(received.pk)
+    received.refresh_from_db()
+    assert run_callback(event, received) == ReceivedCallback.STATE_DONE
+    pending_payment.refresh_from_db()
+    assert pending_payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+
+
+@pytest.mark.django_db
+def test_busy_callback_stays_pending(event, received, monkeypatch):
+    fail_with(monkeypatch, CallbackBusy())
+    received.attempts = MAX_CALLBACK_ATTEMPTS
+    assert run_callback(event, received) == ReceivedCallback.STATE_PENDING
+
+
+@pytest.mark.django_db
+def test_error_is_retried_until_max_attempts(event, received, monkeypatch):
+    fail_with(monkeypatch, RuntimeError('broken'))
+    received.attempts = 1
+    assert run_callback(event, received) == ReceivedCallback.STATE_PENDING
+    received.attempts = MAX_CALLBACK_ATTEMPTS
+    assert run_callback(event, received) == ReceivedCallback.STATE_FAILED
+    received.refresh_from_db()
+    assert received.error == 'broken'
+
+
+@pytest.mark.django_db
+def test_requeue_releases_stale_claims(event, received, monkeypatch):
+    dispatched = []
+    monkeypatch.setattr(tasks.process_received_callback, 'apply_async', lambda kwargs: dispatched.append(kwargs))
+    stale = ReceivedCallback.objects.create(event=event, parameters={}, state=ReceivedCallback.STATE_PROCESSING,
+                                            claimed=now() - tasks.CLAIM_TIMEOUT - timedelta(minutes=1),
+                                            received=now() - timedelta(hours=1))
+    fresh = ReceivedCallback.objects.create(event=event, parameters={}, state=ReceivedCallback.STATE_PROCESSING,
+                                            claimed=now(), received=now() - timedelta(hours=1))
+    tasks.requeue_callbacks()
+    stale.refresh_from_db()
+    fresh.refresh_from_db()
+    assert stale.state == ReceivedCallback.STATE_PENDING
+    assert fresh.state == ReceivedCallback.STATE_PROCESSING
+    # The callback received just now is left to its own task.
+    assert dispatched == [{'event': event.pk, 'callback': stale.pk}]
+
+
+@pytest.mark.django_db
+def test_requeue_deletes_old_processed_callbacks(event, monkeypatch):
+    monkeypatch.setattr(tasks, 'CLEANUP_BATCH_SIZE', 2)
+    old = now() - tasks.callback_retention() - timedelta(hours=1)
+    for i in range(3):
+        ReceivedCallback.objects.create(event=event, parameters={}, state=ReceivedCallback.STATE_DONE, processed=old)
+    failed = ReceivedCallback.objects.create(event=event, parameters={}, state=ReceivedCallback.STATE_FAILED,
+                                             processed=old)
+    recent = ReceivedCallback.objects.create(event=event, parameters={}, state=ReceivedCallback.STATE_DONE,
+                                             processed=now())
+    assert tasks.delete_processed_callbacks() == 3
+    assert set(ReceivedCallback.objects.values_list('pk', flat=True)) == {failed.pk, recent.pk}
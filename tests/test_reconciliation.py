@@ -0,0 +1,70 @@
+import json
+from datetime import timedelta
+
+import pytest
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+
+from pretix.base.models import OrderPayment
+
+from pretix_paymentdibs import reconciliation
+from pretix_paymentdibs.reconciliation import pending_payment_ids, reconcile_pending_payments
+
+
+@pytest.fixture
+def pending(order):
+    payment = order.payments.create(
+        provider='dibs', amount=order.total, state=OrderPayment.PAYMENT_STATE_CREATED,
+        info=json.dumps({'merchant': '12345678'}),
+    )
+    OrderPayment.objects.filter(pk=payment.pk).update(created=now() - timedelta(hours=1))
+    return payment
+
+
+def run():
+    with scopes_disabled():
+        return reconcile_pending_payments()
+
+
+@pytest.mark.django_db
+def test_only_payments_sent_to_dibs_are_pending(order, pending):
+    abandoned = order.payments.create(provider='dibs', amount=order.total, state=OrderPayment.PAYMENT_STATE_CREATED)
+    OrderPayment.objects.filter(pk=abandoned.pk).update(created=now() - timedelta(hours=1))
+    # Too recent
+    order.payments.create(provider='dibs', amount=order.total, state=OrderPayment.PAYMENT_STATE_CREATED,
+                          info=json.dumps({'merchant': '12345678'}))
+    with scopes_disabled():
+        assert list(pending_payment_ids()) == [pending.pk]
+
+
+@pytest.mark.django_db
+def test_found_payment_is_confirmed(pending, transport):
+    t = transport('transact=7654321', 'status=2')
+    assert run() == 1
+    pending.refresh_from_db()
+    assert pending.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+    assert pending.info_data['transact'] == '7654321'
+    assert t.calls[0][2]['orderid'] == 'dummy/dummy/FOOBAR/{}'.format(pending.local_id)
+    assert t.calls[1][2] == {'merchant': '12345678', 'transact': '7654321'}
+
+
+@pytest.mark.django_db
+def test_unknown_payment_is_queried_with_backoff(pending, transport, monkeypatch):
+    clock = [1000000.0]
+    monkeypatch.setattr(reconciliation.time, 'time', lambda: clock[0])
+    # DIBS knows no transaction for the order id
+    t = transport('', '')
+    assert run() == 0
+    assert len(t.calls) == 1
+    # Not again before the backoff has passed
+    run()
+    assert len(t.calls) == 1
+    clock[0] += reconciliation.RECONCILE_BACKOFF
+    run()
+    assert len(t.calls) == 2
+    # Twice as long the second time
+    clock[0] += reconciliation.RECONCILE_BACKOFF
+    run()
+    assert len(t.calls) == 2
+    pending.refresh_from_db()
+    assert pending.state == OrderPayment.PAYMENT_STATE_CREATED
@@ -0,0 +1,174 @@
+from decimal import Decimal
+
+import pytest
+from django.core.cache import cache
+
+from pretix.base.models import OrderRefund
+from pretix.base.payment import PaymentException
+
+from pretix_paymentdibs.circuitbreaker import CircuitBreaker
+from pretix_paymentdibs.client import DIBSClient, set_client
+from pretix_paymentdibs.models import PaymentStatistic
+from pretix_paymentdibs.payment import DIBS, refund_waiting_key
+
+
+@pytest.fixture
+def provider(event):
+    return DIBS(event)
+
+
+def create_refund(payment, amount, state=OrderRefund.REFUND_STATE_CREATED, provider='dibs'):
+    return payment.refunds.create(
+        order=payment.order, source=OrderRefund.REFUND_SOURCE_ADMIN, provider=provider, state=state,
+        amount=Decimal(amount),
+    )
+
+
+def announce(refund):
+    cache.set(refund_waiting_key(refund.payment.pk, refund.pk), True)
+
+
+@pytest.mark.django_db
+def test_refundable_amount_counts_done_dibs_refunds(payment):
+    create_refund(payment, '10.00', OrderRefund.REFUND_STATE_DONE)
+    create_refund(payment, '20.00', OrderRefund.REFUND_STATE_FAILED)
+    create_refund(payment, '30.00', OrderRefund.REFUND_STATE_CREATED)
+    create_refund(payment, '5.00', OrderRefund.REFUND_STATE_DONE, provider='manual')
+    assert DIBS.refundable_amount(payment) == Decimal('90.00')
+
+
+@pytest.mark.django_db
+def test_coalesce_takes_over_waiting_refunds(provider, payment):
+    refund = create_refund(payment, '10.00')
+    waiting = create_refund(payment, '20.00')
+    announce(waiting)
+    refunds, total = provider._coalesce_refunds(refund, Decimal('100.00'))
+    assert refunds == [refund, waiting]
+    assert total == Decimal('30.00')
+    waiting.refresh_from_db()
+    assert waiting.state == OrderRefund.REFUND_STATE_TRANSIT
+
+
+@pytest.mark.django_db
+def test_coalesce_skips_refunds_without_waiting_caller(provider, payment):
+    refund = create_refund(payment, '10.00')
+    abandoned = create_refund(payment, '20.00')
+    refunds, total = provider._coalesce_refunds(refund, Decimal('100.00'))
+    assert refunds == [refund]
+    assert total == Decimal('10.00')
+    abandoned.refresh_from_db()
+    assert abandoned.state == OrderRefund.REFUND_STATE_CREATED
+
+
+@pytest.mark.django_db
+def test_coalesce_skips_refunds_exceeding_refundable_amount(provider, payment):
+    refund = create_refund(payment, '60.00')
+    too_large = create_refund(payment, '50.00')
+    fits = create_refund(payment, '40.00')
+    announce(too_large)
+    announce(fits)
+    refunds, total = provider._coalesce_refunds(refund, Decimal('100.00'))
+    assert refunds == [refund, fits]
+    assert total == Decimal('100.00')
+    too_large.refresh_from_db()
+    assert too_large.state == OrderRefund.REFUND_STATE_CREATED
+
+
+@pytest.mark.django_db
+def test_execute_refund_makes_coalesced_refunds_in_one_call(provider, payment, transport):
+    t = transport('status=ACCEPTED&result=0')
+    refund = create_refund(payment, '10.00')
+    waiting = create_refund(payment, '20.00')
+    announce(waiting)
+    provider.execute_refund(refund)
+    assert len(t.calls) == 1
+    assert t.calls[0][2]['amount'] == '3000'
+    for r in (refund, waiting):
+        r.refresh_from_db()
+        assert r.state == OrderRefund.REFUND_STATE_DONE
+    assert DIBS.refundable_amount(payment) == Decimal('70.00')
+
+
+@pytest.mark.django_db
+def test_failed_refund_returns_coalesced_refunds(provider, payment, transport):
+    transport('status=DECLINED&result=7')
+    refund = create_refund(payment, '10.00')
+    waiting = create_refund(payment, '20.00')
+    announce(waiting)
+    with pytest.raises(PaymentException):
+        provider.execute_refund(refund)
+    refund.refresh_from_db()
+    waiting.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_FAILED
+    assert waiting.state == OrderRefund.REFUND_STATE_CREATED
+
+
+@pytest.mark.django_db
+def test_refund_exceeding_refundable_amount_is_rejected(provider, payment, transport):
+    t = transport()
+    create_refund(payment, '80.00', OrderRefund.REFUND_STATE_DONE)
+    refund = create_refund(payment, '30.00')
+    with pytest.raises(PaymentException):
+        provider.execute_refund(refund)
+    assert t.calls == []
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_FAILED
+
+
+@pytest.mark.django_db
+def test_refund_is_failed_while_circuit_is_open(provider, payment, fake_transport):
+    transport = fake_transport()
+    breaker = CircuitBreaker('test', min_calls=1)
+    breaker.record(False, 0)
+    set_client(DIBSClient(base_url='https://dibs.test', transport=transport, breaker=breaker))
+    refund = create_refund(payment, '10.00')
+    with pytest.raises(PaymentException):
+        provider.execute_refund(refund)
+    assert transport.calls == []
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_FAILED
+    assert refund.execution_date is not None
+    assert PaymentStatistic.objects.get(kind=PaymentStatistic.KIND_REFUND_RESULT, value='circuit_open').count == 1
+
+
+@pytest.mark.django_db
+def test_refund_is_failed_without_api_credentials(event, payment, transport):
+    t = transport()
+    event.settings.delete('payment_dibs_api_password')
+    refund = create_refund(payment, '10.00')
+    with pytest.raises(PaymentException):
+        DIBS(event).execute_refund(refund)
+    assert t.calls == []
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_FAILED
+
+
+def set_capture(payment, capture):
+    info = payment.info_data
+    info['capture'] = capture
+    payment.info_data = info
+    payment.save(update_fields=['info'])
+
+
+@pytest.mark.django_db
+def test_refund_of_authorised_payment_is_rejected(provider, payment, transport):
+    t = transport()
+    set_capture(payment, DIBS.CAPTURE_PENDING)
+    refund = create_refund(payment, '10.00')
+    with pytest.raises(PaymentException):
+        provider.execute_refund(refund)
+    assert t.calls == []
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_FAILED
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('capture', [DIBS.CAPTURE_SKIPPED, DIBS.CAPTURE_FAILED])
+def test_refund_of_uncaptured_payment_is_done_without_dibs(provider, payment, transport, capture):
+    t = transport()
+    set_capture(payment, capture)
+    refund = create_refund(payment, '10.00')
+    provider.execute_refund(refund)
+    assert t.calls == []
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_DONE
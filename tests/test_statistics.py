@@ -0,0 +1,42 @@
+from datetime import timedelta
+
+import pytest
+from django.core.management import call_command
+from django.utils.timezone import now
+
+from pretix.base.models import LogEntry
+
+from pretix_paymentdibs import hashing
+from pretix_paymentdibs.models import PaymentStatistic
+
+from .conftest import MD5_KEY1, MD5_KEY2
+
+
+def log_callback(order, authkey, days_ago=1):
+    order.log_action('pretix_paymentdibs.callback', data={
+        'transact': '1234567', 'statuscode': 2, 'currency_code': '208', 'authkey': authkey, 'merchant': '12345678',
+    })
+    entry = LogEntry.objects.filter(action_type='pretix_paymentdibs.callback').order_by('-pk').first()
+    LogEntry.objects.filter(pk=entry.pk).update(datetime=now() - timedelta(days=days_ago))
+
+
+def counters(event):
+    return {(s.kind, s.value): s.count for s in PaymentStatistic.objects.filter(event=event)}
+
+
+@pytest.mark.django_db
+def test_backfill_counts_only_verified_callbacks(event, order, payment):
+    log_callback(order, hashing.authkey(MD5_KEY1, MD5_KEY2, '1234567', '10000', '208'))
+    log_callback(order, '0' * 32)
+    call_command('dibs_backfill_statistics', organizer='dummy', event='dummy')
+    assert counters(event) == {(PaymentStatistic.KIND_STATUSCODE, '2'): 1}
+
+
+@pytest.mark.django_db
+def test_backfill_keeps_todays_counters(event, order, payment):
+    PaymentStatistic.objects.create(event=event, date=now().astimezone(event.timezone).date(),
+                                    kind=PaymentStatistic.KIND_STATUSCODE, value='2', count=5)
+    log_callback(order, hashing.authkey(MD5_KEY1, MD5_KEY2, '1234567', '10000', '208'))
+    log_callback(order, hashing.authkey(MD5_KEY1, MD5_KEY2, '1234567', '10000', '208'), days_ago=0)
+    call_command('dibs_backfill_statistics', organizer='dummy', event='dummy')
+    assert sorted(PaymentStatistic.objects.values_list('count', flat=True)) == [1, 5]
@@ -0,0 +1,30 @@
+import pytest
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+
+from pretix_paymentdibs import transactions
+from pretix_paymentdibs.models import DIBSTransaction
+
+
+@pytest.mark.django_db
+def test_record_payment_updates_the_row(payment):
+    transactions.record_payment(payment, payment.info_data, '12345678')
+    transactions.record_payment(payment, dict(payment.info_data, statuscode=5), '12345678')
+    t = DIBSTransaction.objects.get(payment=payment)
+    assert t.statuscode == 5
+    assert transactions.find_payment('dummy/dummy/FOOBAR/1') == payment
+
+
+@pytest.mark.django_db
+def test_one_row_per_payment(payment):
+    transactions.record_payment(payment, payment.info_data, '12345678')
+    with pytest.raises(IntegrityError), transaction.atomic():
+        DIBSTransaction.objects.create(kind=DIBSTransaction.KIND_PAYMENT, payment=payment,
+                                       **transactions.payment_values(payment, payment.info_data, '12345678'))
+
+
+@pytest.mark.django_db
+def test_backfill_keeps_existing_rows(payment):
+    call_command('dibs_backfill_transactions')
+    call_command('dibs_backfill_transactions')
+    assert DIBSTransaction.objects.filter(payment=payment).count() == 1